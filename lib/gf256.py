@@ -0,0 +1,77 @@
+##########################################
+# File:             gf256.py
+##########################################
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''
+    Galois field GF(2^8) arithmetic shared by the
+    Reed-Solomon encoder and decoder.
+
+    EXP and LOG are the anti-log and log tables of
+    the QR code field, MUL the full product table
+    indexed by x << 8 | y, and ROWS[c] the view of
+    MUL mapping y to c * y.
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''
+
+# Primitive polynomial x^8 + x^4 + x^3 + x^2 + 1 of QR codes.
+PRIM = 0x11d
+
+# Tables by (primitive polynomial, generator, exponent).
+_tables = {}
+
+
+def mulNoLUT(x, y, prim=PRIM, size=256):
+    '''Multiplication without tables, by shifts and reductions.'''
+    r = 0
+    while y:
+        if y & 1:
+            r ^= x
+        y >>= 1
+        x <<= 1
+        if x & size:
+            x ^= prim
+    return r
+
+
+def tables(prim=PRIM, generator=2, c_exp=8):
+    '''
+    Cached tuple(exp, log, mul, rows) of GF(2^c_exp) with the given
+    primitive polynomial and generator.
+    exp has 2 * (2^c_exp - 1) entries, so that exp[log[x] + log[y]]
+    needs no modulo. log[0] is unused. mul[x << c_exp | y] is x * y,
+    and rows[x] the memoryview of mul for x.
+    '''
+    key = (prim, generator, c_exp)
+    try:
+        return _tables[key]
+    except KeyError:
+        pass
+    size = 1 << c_exp
+    charac = size - 1
+    exp = bytearray(2 * charac)
+    log = bytearray(size)
+    x = 1
+    for i in range(charac):
+        exp[i] = x
+        log[x] = i
+        x = mulNoLUT(x, generator, prim, size)
+    exp[charac:] = exp[:charac]
+    # Row 0 and column 0 stay 0, the other rows are the exp table
+    # read in the order of the logs of y.
+    mul = bytearray(size * size)
+    logs = log[1:]
+    for x in range(1, size):
+        row = exp[log[x]:log[x] + charac]
+        mul[x << c_exp | 1:(x + 1) << c_exp] = bytes(row[l] for l in logs)
+    view = memoryview(mul)
+    rows = [view[x << c_exp:(x + 1) << c_exp] for x in range(size)]
+    res = _tables[key] = (exp, log, mul, rows)
+    return res
+
+
+EXP, LOG, MUL, ROWS = tables()
+
+
+def power(x, n):
+    '''x to the power n.'''
+    return EXP[(LOG[x] * n) % 255]
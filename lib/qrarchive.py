@@ -0,0 +1,99 @@
+##########################################
+# File:             qrarchive.py
+##########################################
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''
+    Sequential ZIP and TAR archives written entry
+    by entry as images are produced, to a path, a
+    binary file object or the standard output.
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import io
+import sys
+import tarfile
+import time
+import zipfile
+
+# Archive kinds by filename suffix, and tarfile stream modes.
+_suffixes = (
+    ('.zip', 'zip'),
+    ('.tar', 'tar'),
+    ('.tar.gz', 'tar.gz'),
+    ('.tgz', 'tar.gz'),
+    ('.tar.bz2', 'tar.bz2'),
+    ('.tar.xz', 'tar.xz'),
+)
+_tarModes = {'tar': 'w|', 'tar.gz': 'w|gz', 'tar.bz2': 'w|bz2',
+             'tar.xz': 'w|xz'}
+
+
+class ArchiveSink(object):
+    '''
+    Archive written one entry at a time, sequentially, without
+    seeking. TAR memory stays constant however many entries it gets,
+    while ZIP keeps its central directory until close, about 100 bytes
+    per entry.
+    filename is a path, a binary file object, or '-' for the
+    standard output. kind is 'zip', 'tar', 'tar.gz', 'tar.bz2' or
+    'tar.xz', by default the one of the filename suffix.
+    ZIP entries are deflated if compress, else stored.
+    '''
+    def __init__(self, filename, kind=None, compress=True):
+        if kind is None:
+            name = getattr(filename, 'name', filename)
+            if isinstance(name, str):
+                for suffix, suffixKind in _suffixes:
+                    if name.lower().endswith(suffix):
+                        kind = suffixKind
+        if kind != 'zip' and kind not in _tarModes:
+            raise ValueError('Error: archive kind must be zip or tar, '
+                             'not {}.'.format(kind))
+        self.kind = kind
+        self.count = 0
+        self._file = None
+        if filename == '-':
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+        elif hasattr(filename, 'write'):
+            out = filename
+        else:
+            out = self._file = open(filename, 'wb')
+        if kind == 'zip':
+            self._archive = zipfile.ZipFile(
+                out, 'w',
+                zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+        else:
+            self._archive = tarfile.open(fileobj=out, mode=_tarModes[kind])
+
+    def add(self, name, data):
+        '''Write an entry name holding the bytes data.'''
+        if self.kind == 'zip':
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.compress_type = self._archive.compression
+            self._archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self._archive.addfile(info, io.BytesIO(data))
+            # A stream is never read back, so forget its members.
+            self._archive.members = []
+        self.count += 1
+
+    def consume(self, entries):
+        '''Write every (name, data) pair of an iterable, as they come.'''
+        for name, data in entries:
+            self.add(name, data)
+        return self.count
+
+    def close(self):
+        '''Finish the archive, and close its file if opened here.'''
+        self._archive.close()
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,226 @@
+##########################################
+# File:             qrcache.py
+##########################################
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''
+    Thread-safe least recently used cache bounded
+    by the total size of its values in bytes.
+
+    Keys are tuples starting with the name of a
+    cache level, so that levels share the byte
+    limit and their hits, misses and evictions
+    are counted apart.
+
+    Persistent cache of files in a directory,
+    named by a hash of their key, that any number
+    of processes can share.
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Age in seconds after which a temporary file of DiskCache is taken
+# for the leftover of a dead process, and pruned.
+_tmpAge = 3600
+
+
+class LRUCache(object):
+    '''
+    Least recently used cache of at most maxBytes, as counted by
+    the sizes given to put. Safe to share between threads.
+    '''
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def _count(self, level, counter):
+        counters = self._counters.setdefault(
+            level, {'hits': 0, 'misses': 0, 'evictions': 0})
+        counters[counter] += 1
+
+    def get(self, key, default=None):
+        '''Value of key, marked most recently used, or default.'''
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self._count(key[0], 'misses')
+                return default
+            self._entries[key] = (value, size)
+            self._count(key[0], 'hits')
+            return value
+
+    def put(self, key, value, size):
+        '''
+        Store value under key as taking size bytes, evicting the
+        least recently used entries beyond maxBytes. A value larger
+        than maxBytes is not stored.
+        '''
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            if size > self.maxBytes:
+                return
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.maxBytes:
+                oldKey, (oldValue, oldSize) = \
+                    self._entries.popitem(last=False)
+                self.bytes -= oldSize
+                self._count(oldKey[0], 'evictions')
+
+    def invalidate(self, match=None):
+        '''
+        Remove the entries whose key satisfies match, or all entries.
+        Return a dict of the removed values by key.
+        '''
+        with self._lock:
+            keys = [key for key in self._entries
+                    if match is None or match(key)]
+            res = {}
+            for key in keys:
+                res[key], size = self._entries.pop(key)
+                self.bytes -= size
+            return res
+
+    def stats(self):
+        '''
+        Dict of the entries, bytes, and of the hits, misses
+        and evictions of every level.
+        '''
+        with self._lock:
+            res = {'entries': len(self._entries), 'bytes': self.bytes}
+            for level, counters in self._counters.items():
+                res[level] = dict(counters)
+            return res
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache(object):
+    '''
+    Files in directory named by the SHA-256 of their key, a string.
+    Every file is written to a temporary file then renamed, so that
+    processes sharing the directory never see a partial file, and
+    touched when found, so that prune removes the least recently
+    used files first.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        '''Path of the file of key, present or not.'''
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        # Two levels keep directories small with millions of files.
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def get(self, key):
+        '''Path of the file of key, or None if absent.'''
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, data):
+        '''Store the bytes data as the file of key and return its path.'''
+        path = self.path(key)
+        folder = os.path.dirname(path)
+        try:
+            os.makedirs(folder)
+        except OSError:
+            if not os.path.isdir(folder):
+                raise
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # mkstemp files are private.
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        finally:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+        return path
+
+    def _files(self):
+        '''
+        (mtime, size, path) of every file, but the temporary files
+        other processes may still be writing.
+        '''
+        res = []
+        old = time.time() - _tmpAge
+        for folder, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(folder, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith('.tmp') and st.st_mtime > old:
+                    continue
+                res.append((st.st_mtime, st.st_size, path))
+        return res
+
+    def size(self):
+        '''Total size of the files in bytes.'''
+        return sum(size for mtime, size, path in self._files())
+
+    def prune(self, maxBytes):
+        '''
+        Remove the least recently used files until the rest take at
+        most maxBytes. Return the number of files removed.
+        '''
+        files = sorted(self._files())
+        total = sum(size for mtime, size, path in files)
+        count = 0
+        for mtime, size, path in files:
+            if total <= maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            count += 1
+        return count
+
+
+def copyFile(source, filename, link=False):
+    '''
+    Copy source to filename, replacing it atomically. With link, hard
+    link filename to source instead where possible, so that both are
+    the same file and writing into either changes the other.
+    '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                               suffix='.tmp')
+    os.close(fd)
+    try:
+        linked = False
+        if link:
+            try:
+                os.remove(tmp)
+                os.link(source, tmp)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            shutil.copyfile(source, tmp)
+            os.chmod(tmp, 0o644)
+        # Renaming a link onto another link of the same file does
+        # nothing, and leaves tmp.
+        os.replace(tmp, filename)
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
@@ -6,17 +6,36 @@
 ##########################################
 
 from util import *
-import copy
+from qrsegment import optimalSegments, encodeSegments, segmentsLength
+from qrsegment import STRUCTURED_APPEND, parity
+from gf256 import ROWS as _gfRows, power as _gfPow
+from qrraster import rowWriters as _rowWriters, sheetRows, renderInto
+from qrvector import writePDF, sheetPDF
+from qrarchive import ArchiveSink
+from qrcache import LRUCache, DiskCache, copyFile
+from util import _imageFormat, _output
+import itertools
+import multiprocessing
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Version of the generated images, part of the disk cache keys.
+# Change it whenever the same arguments give different images.
+VERSION = '1.1'
 
 '''''''''''''''''''''''''''''''''''''''''''''''''''
-    Python version 1-L QR code generator.
-    Other versions to be implemented.
+    Python QR code generator, versions 1 to 40 at
+    L, M, Q and H error control levels.
 
     Coordinate system used:
             i
         o-------->
         |
-      j |   .--> (i, j) for mat[j][i]
+      j |   .--> (i, j) for mat.get(j, i)
         |
         v
 
@@ -24,7 +43,7 @@ import copy
 
 
 class CapacityOverflowException(Exception):
-    '''Exception for data larger than 17 characters in V1-L byte mode.'''
+    '''Exception for data exceeding the capacity of the selected version.'''
     def __init__(self, arg):
         self.arg = arg
 
@@ -32,69 +51,16 @@ class CapacityOverflowException(Exception):
         return repr(self.arg)
 
 
-def _gfpMul(x, y, prim=0x11d, field_charac_full=256, carryless=True):
-    '''Galois field GF(2^8) multiplication.'''
-    r = 0
-    while y:
-        if y & 1:
-            r = r ^ x if carryless else r + x
-        y = y >> 1
-        x = x << 1
-        if prim > 0 and x & field_charac_full:
-            x = x ^ prim
-    return r
-
-# Calculate alphas to simplify GF calculations.
-
-_gfExp = [0] * 512
-_gfLog = [0] * 256
-_gfPrim = 0x11d
-
-_x = 1
-
-for i in range(255):
-    _gfExp[i] = _x
-    _gfLog[_x] = i
-    _x = _gfpMul(_x, 2)
-
-for i in range(255, 512):
-    _gfExp[i] = _gfExp[i-255]
-
-
-def _gfPow(x, pow):
-    '''GF power.'''
-    return _gfExp[(_gfLog[x] * pow) % 255]
-
-
-def _gfMul(x, y):
-    '''Simplified GF multiplication.'''
-    if x == 0 or y == 0:
-        return 0
-    return _gfExp[_gfLog[x] + _gfLog[y]]
-
-
 def _gfPolyMul(p, q):
     '''GF polynomial multiplication.'''
     r = [0] * (len(p) + len(q) - 1)
     for j in range(len(q)):
+        row = _gfRows[q[j]]
         for i in range(len(p)):
-            r[i+j] ^= _gfMul(p[i], q[j])
+            r[i+j] ^= row[p[i]]
     return r
 
 
-def _gfPolyDiv(dividend, divisor):
-    '''GF polynomial division.'''
-    res = list(dividend)
-    for i in range(len(dividend) - len(divisor) + 1):
-        coef = res[i]
-        if coef != 0:
-            for j in range(1, len(divisor)):
-                if divisor[j] != 0:
-                    res[i+j] ^= _gfMul(divisor[j], coef)
-    sep = -(len(divisor) - 1)
-    return res[:sep], res[sep:]
-
-
 def _rsGenPoly(nsym):
     '''Generate generator polynomial for RS algorithm.'''
     g = [1]
@@ -103,20 +69,115 @@ def _rsGenPoly(nsym):
     return g
 
 
-def _rsEncode(bitstring, nsym):
-    '''Encode bitstring with nsym EC bits using RS algorithm.'''
-    gen = _rsGenPoly(nsym)
-    res = [0] * (len(bitstring) + len(gen) - 1)
-    res[:len(bitstring)] = bitstring
-    for i in range(len(bitstring)):
-        coef = res[i]
-        if coef != 0:
-            for j in range(1, len(gen)):
-                res[i+j] ^= _gfMul(gen[j], coef)
-    res[:len(bitstring)] = bitstring
+# Generator polynomials by number of EC codewords, as their
+# coefficients after the leading 1, filled by _rsGen.
+_rsGens = {}
+
+
+def _rsGen(nsym):
+    '''Cached generator polynomial for nsym EC codewords.'''
+    try:
+        return _rsGens[nsym]
+    except KeyError:
+        res = _rsGens[nsym] = tuple(_rsGenPoly(nsym)[1:])
+        return res
+
+
+def _rsRemainder(block, nsym):
+    '''
+    The nsym EC codewords of block: the remainder of its division by
+    the generator polynomial, shifting one data codeword in at a time.
+    '''
+    gen = _rsGen(nsym)
+    rem = [0] * nsym
+    for byte in block:
+        row = _gfRows[byte ^ rem[0]]
+        del rem[0]
+        rem.append(0)
+        for j, coef in enumerate(gen):
+            rem[j] ^= row[coef]
+    return rem
+
+
+# Products of every byte with the generator polynomial coefficients,
+# by number of EC codewords, filled by _rsGenProducts.
+_rsGenTables = {}
+
+
+def _rsGenProducts(nsym):
+    '''
+    Cached products of all 256 coefficients with the generator
+    polynomial for nsym EC codewords: a (256, nsym) NumPy array
+    with NumPy, else a list of nsym-byte big endian ints.
+    '''
+    try:
+        return _rsGenTables[nsym]
+    except KeyError:
+        pass
+    rows = [bytes(bytearray(row[c] for c in _rsGen(nsym))) for row in _gfRows]
+    if numpy is not None:
+        res = numpy.frombuffer(b''.join(rows), dtype=numpy.uint8)
+        res = res.reshape(256, nsym)
+    else:
+        res = [int(''.join('{:02x}'.format(c) for c in bytearray(row)), 16)
+               for row in rows]
+    _rsGenTables[nsym] = res
+    return res
+
+
+def _rsRemainders(blocks, nsym):
+    '''
+    EC codewords of many blocks of the same length at once, identical
+    to those of _rsRemainder. blocks is an (N, k) NumPy array, or a
+    sequence of N sequences of k codewords. With NumPy, return an
+    (N, nsym) uint8 array, computing all N remainders one column at
+    a time. Otherwise return a list of N bytearrays, each remainder
+    being shifted and updated as one big int.
+    '''
+    table = _rsGenProducts(nsym)
+    if numpy is not None:
+        blocks = numpy.asarray(blocks, dtype=numpy.uint8)
+        if blocks.ndim != 2:
+            blocks = blocks.reshape(len(blocks), -1)
+        rem = numpy.zeros((blocks.shape[0], nsym), dtype=numpy.uint8)
+        for column in blocks.T:
+            update = table[column ^ rem[:, 0]]
+            update[:, :-1] ^= rem[:, 1:]
+            rem = update
+        return rem
+    shift = 8 * (nsym - 1)
+    mask = (1 << shift) - 1
+    res = []
+    for block in blocks:
+        rem = 0
+        for byte in bytearray(block):
+            rem = (rem & mask) << 8 ^ table[rem >> shift ^ byte]
+        res.append(bytearray.fromhex('{:0{}x}'.format(rem, 2*nsym)))
     return res
 
 
+def benchmarkRS(count=10000, length=16, nsym=10, seed=0):
+    '''
+    Throughput of RS encoding count random blocks of length data
+    codewords with nsym EC codewords, one block at a time with
+    _rsRemainder and all at once with _rsRemainders.
+    Return a dict of blocks per second for 'single' and 'batch'.
+    '''
+    import random
+    import time
+    rand = random.Random(seed)
+    blocks = [bytearray(rand.randrange(256) for i in range(length))
+              for j in range(count)]
+    start = time.time()
+    singles = [_rsRemainder(block, nsym) for block in blocks]
+    single = time.time() - start
+    start = time.time()
+    batch = _rsRemainders(blocks, nsym)
+    batched = time.time() - start
+    assert [list(bytearray(rem)) for rem in batch] == singles
+    return {'single': count / single, 'batch': count / batched}
+
+
 def _fmtEncode(fmt):
     '''Encode the 15-bit format code using BCH code.'''
     g = 0x537
@@ -127,113 +188,223 @@ def _fmtEncode(fmt):
     return ((fmt << 10) ^ code) ^ 0b101010000010010
 
 
-def _encode(data):
+# Error control levels from lowest to highest recovery capacity,
+# and their 2-bit format codes.
+_levels = 'LMQH'
+_levelBits = {'L': '01', 'M': '00', 'Q': '11', 'H': '10'}
+
+# Error correction codewords per block and number of blocks
+# for each version, index 0 unused.
+_eccPerBlock = {
+    'L': [None, 7, 10, 15, 20, 26, 18, 20, 24, 30, 18, 20, 24, 26, 30, 22,
+          24, 28, 30, 28, 28, 28, 28, 30, 30, 26, 28, 30, 30, 30, 30, 30,
+          30, 30, 30, 30, 30, 30, 30, 30, 30],
+    'M': [None, 10, 16, 26, 18, 24, 16, 18, 22, 22, 26, 30, 22, 22, 24, 24,
+          28, 28, 26, 26, 26, 26, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28,
+          28, 28, 28, 28, 28, 28, 28, 28, 28],
+    'Q': [None, 13, 22, 18, 26, 18, 24, 18, 22, 20, 24, 28, 26, 24, 20, 30,
+          24, 28, 28, 26, 30, 28, 30, 30, 30, 30, 28, 30, 30, 30, 30, 30,
+          30, 30, 30, 30, 30, 30, 30, 30, 30],
+    'H': [None, 17, 28, 22, 16, 22, 28, 26, 26, 24, 28, 24, 28, 22, 24, 24,
+          30, 28, 28, 26, 28, 30, 24, 30, 30, 30, 30, 30, 30, 30, 30, 30,
+          30, 30, 30, 30, 30, 30, 30, 30, 30],
+}
+_eccBlocks = {
+    'L': [None, 1, 1, 1, 1, 1, 2, 2, 2, 2, 4, 4, 4, 4, 4, 6, 6, 6, 6, 7, 8,
+          8, 9, 9, 10, 12, 12, 12, 13, 14, 15, 16, 17, 18, 19, 19, 20, 21,
+          22, 24, 25],
+    'M': [None, 1, 1, 1, 2, 2, 4, 4, 4, 5, 5, 5, 8, 9, 9, 10, 10, 11, 13,
+          14, 16, 17, 17, 18, 20, 21, 23, 25, 26, 28, 29, 31, 33, 35, 37,
+          38, 40, 43, 45, 47, 49],
+    'Q': [None, 1, 1, 2, 2, 4, 4, 6, 6, 8, 8, 8, 10, 12, 16, 12, 17, 16,
+          18, 21, 20, 23, 23, 25, 27, 29, 34, 34, 35, 38, 40, 43, 45, 48,
+          51, 53, 56, 59, 62, 65, 68],
+    'H': [None, 1, 1, 2, 4, 4, 4, 5, 6, 8, 8, 11, 11, 16, 16, 18, 16, 19,
+          21, 25, 25, 25, 34, 30, 32, 35, 37, 40, 42, 45, 48, 51, 54, 57,
+          60, 63, 66, 70, 74, 77, 81],
+}
+
+
+def _blockSizes(version, level='L'):
+    '''
+    Return (list of data codewords in each block, EC codewords
+    per block). Short blocks come first.
+    '''
+    total = numDataModules(version) // 8
+    nblocks = _eccBlocks[level][version]
+    ecc = _eccPerBlock[level][version]
+    short = total // nblocks - ecc
+    nlong = total % nblocks
+    return [short] * (nblocks-nlong) + [short+1] * nlong, ecc
+
+
+# Data codewords for each level and version, index 0 unused.
+_capacity = dict(
+    (level, [0] + [sum(_blockSizes(version, level)[0])
+                   for version in range(1, 41)])
+    for level in _levels
+)
+
+
+def _checkLevel(level):
+    if level not in _levelBits:
+        raise ValueError(
+            'Error: unknown error control level {!r}, expected one of {}.'
+            .format(level, ', '.join(_levels)))
+
+
+def _selectVersion(data, level='L'):
+    '''
+    Auto mode: look up the smallest version holding the optimal
+    segmentation of data at no less than the given error control level
+    in the capacity table, then raise the level as far as that version
+    allows. Return tuple(version, level).
+    '''
+    _checkLevel(level)
+    # The segmentation only changes with the character count lengths,
+    # for versions 1-9, 10-26 and 27-40.
+    for first, last in ((1, 9), (10, 26), (27, 40)):
+        bits = segmentsLength(optimalSegments(data, first), first)
+        if bits <= 8 * _capacity[level][last]:
+            break
+    else:
+        raise CapacityOverflowException(
+            'Error: data needs {} bits, more than the {} bits of a '
+            'version 40-{} QR code.'.format(bits, 8*_capacity[level][40],
+                                            level))
+    for version in range(first, last+1):
+        if bits <= 8 * _capacity[level][version]:
+            break
+    for higher in _levels[_levels.index(level)+1:]:
+        if bits <= 8 * _capacity[higher][version]:
+            level = higher
+    return version, level
+
+
+def _interleave(blocks):
+    '''Interleave codeword blocks, taking one codeword from each in turn.'''
+    res = []
+    for i in range(max(len(block) for block in blocks)):
+        for block in blocks:
+            if i < len(block):
+                res.append(block[i])
+    return res
+
+
+def _deinterleave(codewords, sizes):
+    '''Split interleaved codewords back into blocks of the given sizes.'''
+    blocks = [[] for size in sizes]
+    it = iter(codewords)
+    for i in range(max(sizes)):
+        for block, size in zip(blocks, sizes):
+            if i < size:
+                block.append(next(it))
+    return blocks
+
+
+def _rsEncodeBlocks(data, sizes, nsym):
+    '''
+    Split the data codewords into blocks of the given sizes, add nsym
+    EC codewords to each, and return all data codewords interleaved
+    followed by all EC codewords interleaved.
+    '''
+    blocks = []
+    k = 0
+    for size in sizes:
+        blocks.append(data[k:k+size])
+        k += size
+    # Leading zero codewords do not change the remainder, so short
+    # blocks are padded to encode all blocks in one batch.
+    longest = max(sizes)
+    ecBlocks = _rsRemainders([bytearray(longest - len(block)) + block
+                              for block in blocks], nsym)
+    return _interleave(blocks) + _interleave([list(bytearray(ec))
+                                              for ec in ecBlocks])
+
+
+def _encode(data, version=1, level='L', structure=None):
     '''
     Encode the input data stream.
-    Add mode prefix, encode data using ISO-8859-1,
-    group data, add padding suffix, and call RS encoding method.
+    Split data into numeric, alphanumeric, byte and kanji
+    segments, encode them with mode prefix and character count,
+    add padding suffix, split into blocks, call RS encoding
+    method and interleave the blocks.
+    structure: (position, number of symbols, parity) to start
+    with a Structured Append header.
     '''
-    if len(data) > 17:
+    _checkLevel(level)
+    sizes, ecc = _blockSizes(version, level)
+    capacity = sum(sizes)
+    buf = BitBuffer()
+    if structure is not None:
+        position, total, check = structure
+        buf.append(STRUCTURED_APPEND, 4)
+        buf.append(position, 4)
+        buf.append(total-1, 4)
+        buf.append(check, 8)
+    encodeSegments(optimalSegments(data, version), version, buf)
+    if len(buf) > 8 * capacity:
         raise CapacityOverflowException(
-            'Error: Version 1 QR code encodes no more than 17 characters.')
-    # Byte mode prefix 0100.
-    bitstring = '0100'
-    # Character count in 8 binary bits.
-    bitstring += '{:08b}'.format(len(data))
-    # Encode every character in ISO-8859-1 in 8 binary bits.
-    for c in data:
-        bitstring += '{:08b}'.format(ord(c.encode('iso-8859-1')))
-    # Terminator 0000.
-    bitstring += '0000'
-    res = list()
-    # Convert string to byte numbers.
-    while bitstring:
-        res.append(int(bitstring[:8], 2))
-        bitstring = bitstring[8:]
+            'Error: data needs {} bits, more than the {} bits of a '
+            'version {}-{} QR code.'.format(len(buf), 8*capacity,
+                                            version, level))
+    # Terminator 0000, truncated if the symbol is full.
+    buf.append(0, min(4, 8*capacity - len(buf)))
+    # Byte numbers, the last one padded with 0 bits.
+    res = buf.codewords()
     # Add padding pattern.
-    while len(res) < 19:
-        res.append(int('11101100', 2))
-        res.append(int('00010001', 2))
-    # Slice to 19 bytes for V1-L.
-    res = res[:19]
-    # Call _rsEncode to add 7 EC bits.
-    return _rsEncode(res, 7)
-
-
-def _fillByte(byte, downwards=False):
-    '''
-    Fill a byte into a 2 by 4 matrix upwards,
-    unless specified downwards.
-    Upwards:    Downwards:
-        0|1         6|7
-        -+-         -+-
-        2|3         4|5
-        -+-         -+-
-        4|5         2|3
-        -+-         -+-
-        6|7         0|1
-    '''
-    bytestr = '{:08b}'.format(byte)
-    res = [[0, 0] for i in range(4)]
-    for i in range(8):
-        res[i // 2][i % 2] = not int(bytestr[7-i])
-    if downwards:
-        res = res[::-1]
-    return res
+    while len(res) < capacity:
+        res.append(0b11101100)
+        res.append(0b00010001)
+    # Slice to the data capacity of the version.
+    res = res[:capacity]
+    # Split into blocks, add EC codewords and interleave.
+    return _rsEncodeBlocks(res, sizes, ecc)
 
 
-def _fillData(bitstream):
-    '''Fill the encoded data into the template QR code matrix'''
-    res = copy.deepcopy(ver1Temp)
-    for i in range(15):
-        res = copyFrom(_fillByte(bitstream[i], (i//3) % 2 != 0),
-                       res,
-                       21-4*((i % 3-1)*(-1)**((i//3) % 2)+2),
-                       21-2*(i//3+1))
-    tmp = _fillByte(bitstream[15])
-    res = copyFrom(tmp[2:], res, 7, 11)
-    res = copyFrom(tmp[:2], res, 4, 11)
-    tmp = _fillByte(bitstream[16])
-    res = copyFrom(tmp, res, 0, 11)
-    tmp = _fillByte(bitstream[17], True)
-    res = copyFrom(tmp, res, 0, 9)
-    tmp = _fillByte(bitstream[18], True)
-    res = copyFrom(tmp[:2], res, 4, 9)
-    res = copyFrom(tmp[2:], res, 7, 9)
-    for i in range(3):
-        res = copyFrom(_fillByte(bitstream[19+i], True),
-                       res, 9+4*i, 9)
-    tmp = _fillByte(bitstream[22])
-    res = copyFrom(tmp, res, 9, 7)
-    for i in range(3):
-        res = copyFrom(_fillByte(bitstream[23+i], i % 2 == 0),
-                       res, 9, 4-2*i)
+def _fillData(bitstream, version=1):
+    '''
+    Fill the encoded data into a copy of the template QR code
+    matrix, one bit per precomputed module coordinate.
+    '''
+    res = verTemplate(version).copy()
+    rows = res.rows
+    last = res.width - 1
+    positions = dataPositions(version)
+    k = 0
+    for byte in bitstream:
+        for shift in range(7, -1, -1):
+            if byte >> shift & 1:
+                j, i = positions[k]
+                rows[j] |= 1 << (last-i)
+            k += 1
     # Generate image after filling data for debug use.
     if DEBUG:
         genImage(res, 210, 'data.jpg')
     return res
 
 
-def _fillInfo(arg):
+def _fillInfo(arg, level='L'):
     '''
-    Fill the encoded format code into the masked QR code matrix.
+    Fill the encoded format code into the masked QR code matrix,
+    in place.
     arg: (masked QR code matrix, mask number).
     '''
     mat, mask = arg
-    # 01 is the format code for L error control level,
+    # The 2-bit format code of the error control level is
     # concatenated with mask id and passed into _fmtEncode
     # to get the 15 bits format code with EC bits.
-    fmt = _fmtEncode(int('01'+'{:03b}'.format(mask), 2))
-    fmtarr = [[not int(c)] for c in '{:015b}'.format(fmt)]
-    mat = copyFrom(transpose(fmtarr[7:]), mat, 8, 13)
-    mat = copyFrom(fmtarr[9:][::-1], mat, 0, 8)
-    mat = copyFrom(fmtarr[7:9][::-1], mat, 7, 8)
-    mat = copyFrom(fmtarr[:7][::-1], mat, 14, 8)
-    mat = copyFrom(transpose(fmtarr[:6]), mat, 8, 0)
-    mat = copyFrom([fmtarr[6]], mat, 8, 7)
+    fmt = _fmtEncode(int(_levelBits[level]+'{:03b}'.format(mask), 2))
+    for coords in formatPositions((len(mat)-17) // 4):
+        for b, (j, i) in enumerate(coords):
+            mat.set(j, i, fmt >> b & 1)
     return mat
 
 
+# Runs of 5 or more modules of the same colour.
+_runPattern = re.compile('0{5,}|1{5,}')
+
+
 def _penalty(mat):
     '''
     Calculate penalty score for a masked matrix.
@@ -243,7 +414,8 @@ def _penalty(mat):
         consecutive pixels.
     N2: penalty for blocks of pixels larger than 2x2.
         3*(m-1)*(n-1) points for each block of mxn
-        (larger than 2x2).
+        (larger than 2x2), that is 3 points for each
+        2x2 block of one colour.
     N3: penalty for patterns similar to the finder pattern.
         40 points for each occurrence of 1:1:3:1:1 ratio
         (dark:light:dark:light:dark) pattern in row/column,
@@ -252,122 +424,657 @@ def _penalty(mat):
         10*k points where k is the rating of the deviation of
         the proportion of dark pixels from 50% in steps of 5%.
     '''
-    # Initialize.
-    n1 = n2 = n3 = n4 = 0
-    # Calculate N1.
-
-    def getN1(mat, strategy):
-        n1 = 0
-        for j in range(len(mat)):
-            count = 1
-            adj = False
-            for i in range(1, len(mat)):
-                if strategy == "j":
-                    compare = mat[j][i-1]
-                elif strategy == "i":
-                    i, j = j, i
-                    compare = mat[j-1][i]
-                if mat[j][i] == compare:
-                    count += 1
-                else:
-                    count = 1
-                    adj = False
-                if count >= 5:
-                    if not adj:
-                        adj = True
-                        n1 += 3
-                    else:
-                        n1 += 1
-        return n1
-
-    n1 = getN1(mat, "i") + getN1(mat, "j")
-
-    # Calculate N2.
-    m = n = 1
-    for j in range(1, len(mat)):
-        for i in range(1, len(mat)):
-            if (mat[j][i] == mat[j-1][i] and mat[j][i] == mat[j][i-1] and
-                mat[j][i] == mat[j-1][i-1]):
-                if mat[j][i] == mat[j-1][i]:
-                    m += 1
-                if mat[j][i] == mat[j][i-1]:
-                    n += 1
-            else:
-                n2 += 3 * (m-1) * (n-1)
-                m = n = 1
-
-    # Calculate N3.
-    count = 0
-
-    def getCount(mat):
-        count = 0
-        for row in mat:
-            rowstr = ''.join(str(e) for e in row)
-            occurrences = []
-            begin = 0
-            while rowstr.find('0100010', begin) != -1:
-                begin = rowstr.find('0100010', begin) + 7
-                occurrences.append(begin)
-            for begin in occurrences:
-                if (rowstr.count('00000100010', begin-4) != 0 or
-                    rowstr.count('01000100000', begin) != 0):
-                    count += 1
-        return count
-
-    transposedMat = transpose(mat)
-    n3 += 40 * (getCount(mat)+getCount(transposedMat))
-
-    # Calculate N4.
-    dark = sum(row.count(DARK) for row in mat)
+    lines = _lines(mat)
+    return (_penaltyN1(lines) + _penaltyN2(mat) + _penaltyN3(lines) +
+            _penaltyN4(mat))
+
+
+def _lines(mat):
+    '''Rows and columns as strings of '1' (dark) and '0' (light).'''
+    return mat.rowStrings() + mat.transpose().rowStrings()
+
+
+def _penaltyN1(lines):
+    n1 = 0
+    for line in lines:
+        for run in _runPattern.finditer(line):
+            n1 += 3 + len(run.group()) - 5
+    return n1
+
+
+def _penaltyN2(mat):
+    '''N2 penalty, comparing each row with the next one.'''
+    n2 = 0
+    adjacent = (1 << (mat.width-1)) - 1
+    for upper, lower in zip(mat.rows, mat.rows[1:]):
+        same = ~(upper ^ lower)
+        blocks = same & (same >> 1) & ~(upper ^ (upper >> 1)) & adjacent
+        n2 += 3 * bin(blocks).count('1')
+    return n2
+
+
+def _penaltyN3(lines):
+    '''N3 penalty, the outside of the matrix being light.'''
+    n3 = 0
+    for line in lines:
+        line = '0000' + line + '0000'
+        begin = line.find('1011101')
+        while begin != -1:
+            before = line[begin-4:begin]
+            after = line[begin+7:begin+11]
+            if before == '0000' or after == '0000':
+                n3 += 40
+            begin = line.find('1011101', begin+1)
+    return n3
+
+
+def _penaltyN4(mat):
+    dark = mat.count()
     percent = int((float(dark) / float(len(mat)**2)) * 100)
     pre = percent - percent % 5
     nex = percent + 5 - percent % 5
-    n4 = min(abs(pre-50)//5, abs(nex-50)//5) * 10
+    return min(abs(pre-50)//5, abs(nex-50)//5) * 10
+
+
+def _penaltiesNumpy(maskeds):
+    '''
+    Calculate the penalty scores of all masked matrices at once,
+    with the same rules as _penalty, on a stacked NumPy array of
+    shape (masks, size, size) where dark modules are 1.
+    '''
+    size = len(maskeds[0])
+    mats = numpy.frombuffer(
+        ''.join(''.join(m.rowStrings()) for m in maskeds).encode('ascii'),
+        dtype=numpy.uint8).reshape(len(maskeds), size, size) - ord('0')
+    # Rows and columns of every matrix, as (masks, 2*size, size).
+    lines = numpy.concatenate((mats, mats.transpose(0, 2, 1)), axis=1)
+
+    # N1: a run of r >= 5 modules holds r-4 windows of 5 same modules,
+    # and scores r-2, so add 2 for each window starting a run.
+    same = lines[:, :, 1:] == lines[:, :, :-1]
+    windows = same[:, :, :-3] & same[:, :, 1:-2] & same[:, :, 2:-1] & \
+        same[:, :, 3:]
+    starts = numpy.ones_like(windows)
+    starts[:, :, 1:] = ~same[:, :, :-4]
+    n1 = windows.sum(axis=(1, 2)) + 2 * (windows & starts).sum(axis=(1, 2))
+
+    # N2: 2x2 blocks of one colour.
+    top = mats[:, :-1, :-1]
+    blocks = (top == mats[:, 1:, :-1]) & (top == mats[:, :-1, 1:]) & \
+        (top == mats[:, 1:, 1:])
+    n2 = 3 * blocks.sum(axis=(1, 2))
+
+    # N3: 1011101 patterns, with lines padded by 4 light modules
+    # on each side as the outside of the matrix is light.
+    padded = numpy.zeros(lines.shape[:2] + (size+8,), dtype=numpy.uint8)
+    padded[:, :, 4:-4] = lines
+    light = padded == 0
+    light4 = light[:, :, :-3] & light[:, :, 1:-2] & light[:, :, 2:-1] & \
+        light[:, :, 3:]
+    found = numpy.ones(lines.shape[:2] + (size-6,), dtype=bool)
+    for t, bit in enumerate((1, 0, 1, 1, 1, 0, 1)):
+        found &= padded[:, :, 4+t:size-2+t] == bit
+    found &= light4[:, :, :size-6] | light4[:, :, 11:size+5]
+    n3 = 40 * found.sum(axis=(1, 2))
+
+    # N4.
+    percent = (mats.sum(axis=(1, 2)) / float(size**2) * 100).astype(int)
+    pre = percent - percent % 5
+    nex = percent + 5 - percent % 5
+    n4 = numpy.minimum(abs(pre-50)//5, abs(nex-50)//5) * 10
+
+    return [int(score) for score in n1 + n2 + n3 + n4]
+
+
+def _searchMask(maskeds):
+    '''
+    Find the mask with the lowest penalty score, pruning candidates.
+    The cheap N2 and N4 terms of every candidate are scored first
+    and candidates are visited from the lowest. A candidate is
+    abandoned as soon as its partial score cannot beat the best
+    total found so far, ties going to the lower mask number.
+    Return tuple(number of selected mask, penalty score,
+    number of pruned candidates).
+    '''
+    partial = [_penaltyN2(m) + _penaltyN4(m) for m in maskeds]
+    best = None
+    pruned = 0
+    for i in sorted(range(len(maskeds)), key=lambda i: (partial[i], i)):
+        score = partial[i]
+        if best is not None and (score, i) > best:
+            pruned += 1
+            continue
+        lines = _lines(maskeds[i])
+        score += _penaltyN1(lines)
+        if best is not None and (score, i) > best:
+            pruned += 1
+            continue
+        score += _penaltyN3(lines)
+        if best is None or (score, i) < best:
+            best = (score, i)
+    return best[1], best[0], pruned
+
+
+def _penalties(maskeds):
+    '''
+    Calculate penalty scores for all masked matrices,
+    in one batched pass when NumPy is available.
+    '''
+    if numpy is not None:
+        return _penaltiesNumpy(maskeds)
+    return [_penalty(masked) for masked in maskeds]
+
 
-    # Return final penalty score.
-    return n1 + n2 + n3 + n4
+# Mask selection counters since import: candidates pruned by
+# _searchMask, and codes generated with an explicit mask.
+maskStats = {'searched': 0, 'pruned': 0, 'fixed': 0}
 
 
-def _mask(mat):
+def _mask(mat, version=1, mask=None):
     '''
-    Mask the data QR code matrix with all 8 masks,
-    call _penalty to calculate penalty scores for each
-    and select the best mask.
-    Return tuple(selected masked matrix, number of selected mask).
+    Mask the data QR code matrix with the given mask, or with
+    all 8 masks and select the one with the lowest penalty score.
+    With NumPy, all 8 are scored by _penalties in one batch,
+    otherwise _searchMask prunes candidates that cannot win.
+    Return tuple(selected masked matrix, number of selected mask,
+    its penalty score or None if given, number of pruned candidates).
     '''
-    maskeds = [logicXor(mat, dataMask) for dataMask in dataMasks]
-    penalty = [0] * 8
-    for i, masked in enumerate(maskeds):
-        penalty[i] = _penalty(masked)
+    if mask is not None:
+        maskStats['fixed'] += 1
+        return mat ^ dataMasks(version)[mask], mask, None, 0
+    maskeds = [mat ^ dataMask for dataMask in dataMasks(version)]
+    if numpy is not None:
+        penalty = _penalties(maskeds)
         # Print penalty scores for debug use.
         if DEBUG:
-            print('penalty for mask {}: {}'.format(i, penalty[i]))
-    # Find the id of the best mask.
-    selected = penalty.index(min(penalty))
+            for i in range(8):
+                print('penalty for mask {}: {}'.format(i, penalty[i]))
+        # Find the id of the best mask.
+        selected = penalty.index(min(penalty))
+        score, pruned = penalty[selected], 0
+    else:
+        selected, score, pruned = _searchMask(maskeds)
+    maskStats['searched'] += 1
+    maskStats['pruned'] += pruned
     # Print selected mask and penalty score,
     # and generate image for masked QR code for debug use.
     if DEBUG:
-        print('mask {} selected with penalty {}'.format(selected,
-                                                        penalty[selected]))
+        print('mask {} selected with penalty {}, {} pruned'.format(
+            selected, score, pruned))
         genImage(maskeds[selected], 210,
                  'selectedMasked(' + str(selected) + ').jpg')
         for i, masked in enumerate(maskeds):
             if i != selected:
                 genImage(masked, 210, 'masked(' + str(i) + ').jpg')
-    return maskeds[selected], selected
+    return maskeds[selected], selected, score, pruned
 
 
-def _genBitmap(bitstream):
+class QRSymbol(object):
     '''
-    Take in the encoded data stream and generate the
-    final QR code bitmap.
+    Immutable encoded QR code: the final module matrix with its
+    version, error correction level, mask and mask penalty score,
+    None if the mask was given. Render it any number of times
+    without encoding again.
     '''
-    return _fillInfo(_mask(_fillData(bitstream)))
+    __slots__ = ('_matrix', '_version', '_level', '_mask', '_penalty')
+
+    def __init__(self, matrix, version, level, mask, penalty=None):
+        self._matrix = matrix
+        self._version = version
+        self._level = level
+        self._mask = mask
+        self._penalty = penalty
+
+    version = property(lambda self: self._version)
+    level = property(lambda self: self._level)
+    mask = property(lambda self: self._mask)
+    penalty = property(lambda self: self._penalty)
+
+    @property
+    def size(self):
+        '''Number of modules per side.'''
+        return self._matrix.width
+
+    @property
+    def matrix(self):
+        '''Copy of the module matrix as a BitMatrix.'''
+        return self._matrix.copy()
+
+    @property
+    def rows(self):
+        '''
+        Rows as ints of size bits, the most significant bit being
+        the leftmost module. Set bits are dark modules.
+        '''
+        return tuple(self._matrix.rows)
+
+    def toBytes(self):
+        '''
+        Rows packed into bytes, padded to whole bytes,
+        most significant bit first, set bits dark.
+        '''
+        return self._matrix.toBytes()
+
+    def render(self, width=210, filename='qrcode.jpg', format=None):
+        '''
+        Write the symbol as an image width pixels wide to filename,
+        a path or a binary file object, in the given format or the
+        one of the filename extension. With filename None, return
+        the image bytes in format, or the PIL Image if no format.
+        '''
+        return genImage(self._matrix, width, filename, format)
+
+    def renderInto(self, buffer, width, offset=0, stride=None, format='L',
+                   dark=None, light=b''):
+        '''
+        Draw the symbol width pixels wide into a writable buffer at
+        byte offset, with rows stride bytes apart, in pixel format
+        L, RGB, BGR, RGBA, BGRA or ARGB, see qrraster.renderInto.
+        '''
+        renderInto(self._matrix, width, buffer, offset, stride, format,
+                   dark, light)
+
+    def __eq__(self, other):
+        return (isinstance(other, QRSymbol) and
+                self._matrix == other._matrix and
+                self._level == other._level)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((tuple(self._matrix.rows), self._level))
+
+    def __repr__(self):
+        return 'QRSymbol(version={}, level={!r}, mask={})'.format(
+            self._version, self._level, self._mask)
+
+
+def _buildSymbol(data, version, level='L', mask=None, structure=None):
+    '''Run the whole pipeline on data into a QRSymbol.'''
+    mat = _fillData(_encode(data, version, level, structure), version)
+    masked, mask, penalty, pruned = _mask(mat, version, mask)
+    return QRSymbol(_fillInfo((masked, mask), level), version, level, mask,
+                    penalty)
+
+
+def encode(data, version=None, level='L', mask=None):
+    '''
+    Module public interface returning the QRSymbol of data,
+    with the same arguments as generate.
+    '''
+    _checkLevel(level)
+    if mask is not None and mask not in range(8):
+        raise ValueError('Error: mask must be from 0 to 7.')
+    if version is not None and version not in range(1, 41):
+        raise ValueError('Error: version must be from 1 to 40.')
+    if version is None:
+        version, level = _selectVersion(data, level)
+    return _buildSymbol(data, version, level, mask)
+
+
+class QRCache(object):
+    '''
+    Opt-in cache of at most maxBytes, safe to share between threads,
+    with two levels sharing one least recently used order: 'symbols'
+    maps data and encoding options to QRSymbols, and 'images' maps
+    data, encoding options, width and format to image bytes, so that
+    an image hit needs no symbol.
+    '''
+    def __init__(self, maxBytes=1 << 26):
+        self._lru = LRUCache(maxBytes)
+
+    def encode(self, data, version=None, level='L', mask=None):
+        '''Cached encode.'''
+        key = ('symbols', data, version, level, mask)
+        symbol = self._lru.get(key)
+        if symbol is None:
+            symbol = encode(data, version, level, mask)
+            # Rows are Python ints of size bits.
+            self._lru.put(key, symbol,
+                          symbol.size * (28 + symbol.size // 8) + 200)
+        return symbol
+
+    def render(self, data, width=210, format='PNG', version=None,
+               level='L', mask=None):
+        '''Cached image bytes of data in format.'''
+        key = ('images', data, version, level, mask, width,
+               _imageFormat(None, format))
+        image = self._lru.get(key)
+        if image is None:
+            image = self.encode(data, version, level, mask).render(
+                width, None, format)
+            self._lru.put(key, image, len(image) + 100)
+        return image
+
+    def write(self, filename, data, width=210, format='PNG', version=None,
+              level='L', mask=None):
+        '''
+        Write the cached image into filename, a path or binary file
+        object, or return its bytes with filename None.
+        '''
+        return _output(self.render(data, width, format, version, level,
+                                   mask), filename)
+
+    def invalidate(self, data=None):
+        '''
+        Remove the symbols of data with any options and their images,
+        or everything. Return the number of entries removed.
+        '''
+        if data is None:
+            return len(self._lru.invalidate())
+        return len(self._lru.invalidate(lambda key: key[1] == data))
+
+    def stats(self):
+        '''
+        Dict of the entries and bytes held, and of the hits, misses
+        and evictions of the 'symbols' and 'images' levels.
+        '''
+        return self._lru.stats()
+
+
+class QRDiskCache(object):
+    '''
+    Persistent cache of images in directory, which concurrent
+    processes can share. Images are files named by a hash of data,
+    version, level, mask, width, format and VERSION, so that a hit
+    needs no encoding.
+    Hits are copied to their filename, or hard linked with link, which
+    saves the copy but makes the file the cache file itself: writing
+    into it again, even with generate, changes the cached image too.
+    '''
+    def __init__(self, directory, link=False):
+        self._disk = DiskCache(directory)
+        self.link = link
+
+    def encode(self, data, version=None, level='L', mask=None):
+        '''Symbols are not kept on disk.'''
+        return encode(data, version, level, mask)
+
+    def path(self, data, width=210, format='PNG', version=None,
+             level='L', mask=None):
+        '''Path of the cached image file of data in format.'''
+        key = repr((VERSION, data, version, level, mask, width,
+                    _imageFormat(None, format)))
+        path = self._disk.get(key)
+        if path is None:
+            image = encode(data, version, level, mask).render(
+                width, None, format)
+            path = self._disk.put(key, image)
+        return path
 
+    def render(self, data, width=210, format='PNG', version=None,
+               level='L', mask=None):
+        '''Cached image bytes of data in format.'''
+        path = self.path(data, width, format, version, level, mask)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except IOError:
+            # Pruned by another process in between.
+            return encode(data, version, level, mask).render(
+                width, None, format)
 
-def generate(data, width=210, filename='qrcode.jpg'):
-    '''Module public interface'''
+    def write(self, filename, data, width=210, format='PNG', version=None,
+              level='L', mask=None):
+        '''
+        Copy or link the cached image to the path filename, write it
+        into a binary file object, or return its bytes with filename
+        None.
+        '''
+        if not isinstance(filename, str):
+            return _output(self.render(data, width, format, version, level,
+                                       mask), filename)
+        path = self.path(data, width, format, version, level, mask)
+        try:
+            copyFile(path, filename, self.link)
+        except IOError:
+            _output(self.render(data, width, format, version, level, mask),
+                    filename)
+
+    def size(self):
+        '''Total size of the cached images in bytes.'''
+        return self._disk.size()
+
+    def prune(self, maxBytes):
+        '''
+        Remove the least recently used images until the rest take at
+        most maxBytes. Return the number of images removed.
+        '''
+        return self._disk.prune(maxBytes)
+
+
+def generate(data, width=210, filename='qrcode.jpg', version=None,
+             level='L', mask=None, format=None, cache=None):
+    '''
+    Module public interface.
+    level is one of 'L', 'M', 'Q' and 'H'. Unless a version is
+    specified, auto mode selects the smallest version holding data
+    at no less than level, and the highest level fitting that version.
+    mask from 0 to 7 skips the mask search.
+    filename is a path or a binary file object, written in format
+    or the format of the filename extension. With filename None,
+    return the image bytes in format, or the PIL Image if no format.
+    cache is an optional QRCache or QRDiskCache to look the code and
+    image up first.
+    '''
+    try:
+        if cache is None:
+            return encode(data, version, level, mask).render(
+                width, filename, format)
+        kind = _imageFormat(filename, format)
+        if kind is None:
+            return cache.encode(data, version, level, mask).render(
+                width, filename, format)
+        return cache.write(filename, data, width, kind, version, level,
+                           mask)
+    except Exception as e:
+        raise e
+
+
+# Structured Append header length in bits, and maximum number of symbols.
+_structureBits = 20
+_maxSymbols = 16
+
+
+def _splitData(data, version, level='L'):
+    '''
+    Split data into the fewest parts that fit a version with
+    a Structured Append header, taking the longest prefix that
+    fits each time. The optimal length only grows with the prefix,
+    so the prefix is found by binary search.
+    Stop early and return None past 16 parts.
+    '''
+    capacity = 8 * _capacity[level][version] - _structureBits
+    parts = []
+    start = 0
+    while start < len(data) or not parts:
+        if len(parts) == _maxSymbols:
+            return None
+        # No part holds more characters than numeric mode allows.
+        lo, hi = start, min(len(data), start + capacity * 3 // 10)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            segments = optimalSegments(data[start:mid], version)
+            if segmentsLength(segments, version) <= capacity:
+                lo = mid
+            else:
+                hi = mid - 1
+        if lo == start and start < len(data):
+            return None
+        parts.append(data[start:lo])
+        start = lo
+    return parts
+
+
+def _generateSymbol(args):
+    '''Build and write one symbol of a set, in a worker process.'''
+    data, structure, version, level, mask, width, filename = args
+    _buildSymbol(data, version, level, mask, structure).render(width,
+                                                               filename)
+    return filename
+
+
+def generateSet(data, width=210, filename='qrcode{}.jpg', version=None,
+                level='L', mask=None, workers=None):
+    '''
+    Structured Append interface.
+    Split data across up to 16 symbols of the same version, each with
+    its position in the set and the parity of data, and build them
+    concurrently on a pool of workers processes, all of them unless
+    specified. Unless a version is specified, the smallest version
+    needing no more than 16 symbols is selected.
+    filename is formatted with the position of each symbol, from 1.
+    Return the list of written filenames, in order.
+    As the workers may import the main module again, scripts must call
+    it under if __name__ == '__main__'.
+    '''
+    try:
+        _checkLevel(level)
+        if mask is not None and mask not in range(8):
+            raise ValueError('Error: mask must be from 0 to 7.')
+        if version is not None and version not in range(1, 41):
+            raise ValueError('Error: version must be from 1 to 40.')
+        if version is None:
+            # The number of parts only decreases with larger versions.
+            lo, hi = 1, 40
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if _splitData(data, mid, level) is None:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            version = lo
+        parts = _splitData(data, version, level)
+        if parts is None:
+            raise CapacityOverflowException(
+                'Error: data does not fit in {} version {}-{} QR codes.'
+                .format(_maxSymbols, version, level))
+        if len(parts) > 1 and filename.format(1) == filename.format(2):
+            raise ValueError('Error: filename must contain {} to write '
+                             'more than one symbol.')
+        check = parity(data)
+        jobs = [(part, (k, len(parts), check), version, level, mask, width,
+                 filename.format(k+1)) for k, part in enumerate(parts)]
+        if workers == 1 or len(jobs) == 1:
+            return [_generateSymbol(job) for job in jobs]
+        pool = multiprocessing.Pool(workers)
+        try:
+            return pool.map(_generateSymbol, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    except Exception as e:
+        raise e
+
+
+def _pages(data, size, version, level, mask):
+    '''Lists of the module matrices of up to size items of data.'''
+    items = iter(data)
+    while True:
+        page = [encode(item, version, level, mask).matrix
+                for item in itertools.islice(items, size)]
+        if not page:
+            return
+        yield page
+
+
+def generateSheet(data, width=210, filename='sheet{}.png', rows=8,
+                  columns=6, gutter=30, dpi=300, version=None, level='L',
+                  mask=None, format=None):
+    '''
+    Sheet interface.
+    Lay out the QR codes of every item of the iterable data on pages
+    of rows by columns codes, each width pixels wide, with gutter
+    light pixels around and between them, at dpi pixels per inch.
+    PNG and PBM pages are written to one file each, filename being
+    formatted with the page number from 1, and PDF pages to a single
+    file, path or binary file object, with codes drawn as vectors.
+    A PNG or PBM filename without {}, or file object, holds one page.
+    Only one page of codes is held in memory at a time.
+    Return the list of written filenames.
+    '''
+    try:
+        kind = _imageFormat(filename, format)
+        if not kind:
+            raise ValueError('Error: filename must have an extension, '
+                             'or a format be given.')
+        size = rows * columns
+        # Peek at the items to know if there is more than one page.
+        items = iter(data)
+        head = list(itertools.islice(items, size + 1))
+        if not head:
+            raise ValueError('Error: data has no items to lay out.')
+        pages = _pages(itertools.chain(head, items), size, version, level,
+                       mask)
+        if kind == 'PDF':
+            scale = 72.0 / dpi
+            side = (lambda n: n * (width + gutter) + gutter)
+            writer = (sheetPDF(page, width * scale, rows, columns,
+                               gutter * scale) for page in pages)
+            if hasattr(filename, 'write'):
+                writePDF(writer, side(columns) * scale, side(rows) * scale,
+                         filename)
+            else:
+                with open(filename, 'wb') as f:
+                    writePDF(writer, side(columns) * scale,
+                             side(rows) * scale, f)
+            return [filename]
+        if kind not in _rowWriters:
+            raise ValueError('Error: sheets are PNG, PBM or PDF, not {}.'
+                             .format(kind))
+        if len(head) > size and (hasattr(filename, 'write') or
+                                 filename.format(1) == filename.format(2)):
+            raise ValueError('Error: filename must contain {} to write '
+                             'more than one page.')
+
+        def write(page, out):
+            _rowWriters[kind](sheetRows(page, width, rows, columns, gutter),
+                              columns * (width + gutter) + gutter,
+                              rows * (width + gutter) + gutter, out, dpi)
+
+        if hasattr(filename, 'write'):
+            write(next(pages), filename)
+            return [filename]
+        res = []
+        for number, page in enumerate(pages):
+            name = filename.format(number + 1)
+            with open(name, 'wb') as f:
+                write(page, f)
+            res.append(name)
+        return res
+    except Exception as e:
+        raise e
+
+
+# Image formats already compressed, stored as they are in ZIP archives.
+_compressedFormats = ('PNG', 'JPEG', 'GIF', 'PDF')
+
+
+def generateArchive(data, filename='qrcodes.zip', width=210,
+                    names='qrcode{}.png', version=None, level='L',
+                    mask=None, format=None, kind=None):
+    '''
+    Archive interface.
+    Write the QR code of every item of the iterable data into one
+    ZIP or TAR archive, filename being a path, a binary file object
+    or '-' for the standard output, and kind the archive kind unless
+    given by the filename suffix. Entries are named after names,
+    formatted with the position of each item from 1, in format or
+    the format of their extension, and written as soon as rendered.
+    Return the number of entries.
+    '''
     try:
-        genImage(_genBitmap(_encode(data)), width, filename)
+        imageFormat = _imageFormat(names, format)
+        if not imageFormat:
+            raise ValueError('Error: names must have an extension, '
+                             'or a format be given.')
+        entries = ((names.format(k + 1),
+                    encode(item, version, level, mask).render(width, None,
+                                                              imageFormat))
+                   for k, item in enumerate(data))
+        with ArchiveSink(filename, kind,
+                         imageFormat not in _compressedFormats) as sink:
+            return sink.consume(entries)
     except Exception as e:
         raise e
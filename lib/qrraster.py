@@ -0,0 +1,225 @@
+##########################################
+# File:             qrraster.py
+##########################################
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''
+    Raster output of module matrices in 1-bit PNG
+    and PBM, with the standard library only,
+    streamed row by row to a binary file object.
+
+    Like the PIL output, modules are width // size
+    pixels wide, and the pixels left over on the
+    right and bottom edges are light.
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import re
+import struct
+import zlib
+
+
+def pixelRows(bitmap, width):
+    '''
+    Rows of pixels of the image of a BitMatrix width pixels wide,
+    as strings of '1' for dark and '0' for light pixels.
+    Each module row is scaled once and the same string repeated.
+    '''
+    pwidth = width // bitmap.width
+    if pwidth == 0:
+        raise ValueError('Error: width must be at least {} pixels.'.format(
+            bitmap.width))
+    scale = {ord('1'): '1' * pwidth, ord('0'): '0' * pwidth}
+    pad = '0' * (width - pwidth * bitmap.width)
+    for row in bitmap.rowStrings():
+        bits = row.translate(scale) + pad
+        for k in range(pwidth):
+            yield bits
+    light = '0' * width
+    for k in range(width - pwidth * bitmap.height):
+        yield light
+
+
+def _pack(rows, width, dark):
+    '''
+    Pack rows of pixels width pixels wide into bytes, padded to whole
+    bytes, dark pixels being bit dark. A row repeated as the same
+    string is packed only once.
+    '''
+    nbytes = (width + 7) // 8
+    pad = '0' * (-width % 8)
+    invert = 0 if dark else (1 << 8*nbytes) - 1
+    last = line = None
+    for bits in rows:
+        if bits is not last:
+            line = bytearray.fromhex('{:0{}x}'.format(
+                int(bits + pad, 2) ^ invert, 2*nbytes))
+            last = bits
+        yield line
+
+
+def _chunk(kind, data):
+    '''PNG chunk with its length and CRC.'''
+    return struct.pack('>I', len(data)) + kind + data + \
+        struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+# Compressed bytes gathered into each PNG IDAT chunk.
+_chunkSize = 1 << 16
+
+
+def writePNGRows(rows, width, height, out, dpi=None):
+    '''
+    Stream a 1-bit greyscale PNG image of the given rows of pixels
+    into the binary file object out, one row at a time, so memory
+    stays proportional to width. dpi sets the physical pixel size.
+    '''
+    out.write(b'\x89PNG\r\n\x1a\n')
+    out.write(_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                          1, 0, 0, 0, 0)))
+    if dpi:
+        # Pixels per metre.
+        ppm = int(round(dpi / 0.0254))
+        out.write(_chunk(b'pHYs', struct.pack('>IIB', ppm, ppm, 1)))
+    compressor = zlib.compressobj()
+    pending = []
+    size = 0
+    # Every scanline starts with filter type 0, and 0 is black.
+    for line in _pack(rows, width, 0):
+        data = compressor.compress(b'\0' + line)
+        if data:
+            pending.append(data)
+            size += len(data)
+            if size >= _chunkSize:
+                out.write(_chunk(b'IDAT', b''.join(pending)))
+                pending = []
+                size = 0
+    pending.append(compressor.flush())
+    out.write(_chunk(b'IDAT', b''.join(pending)))
+    out.write(_chunk(b'IEND', b''))
+
+
+def writePBMRows(rows, width, height, out, dpi=None):
+    '''
+    Stream a binary PBM image of the given rows of pixels into the
+    binary file object out, one row at a time. PBM has no dpi.
+    '''
+    out.write('P4\n{} {}\n'.format(width, height).encode('ascii'))
+    # 1 is black.
+    for line in _pack(rows, width, 1):
+        out.write(line)
+
+
+def writePNG(bitmap, width, out):
+    '''Stream a PNG image of a BitMatrix width pixels wide into out.'''
+    writePNGRows(pixelRows(bitmap, width), width, width, out)
+
+
+def writePBM(bitmap, width, out):
+    '''Stream a PBM image of a BitMatrix width pixels wide into out.'''
+    writePBMRows(pixelRows(bitmap, width), width, width, out)
+
+
+def sheetRows(bitmaps, width, rows, columns, gutter):
+    '''
+    Rows of pixels of a page of rows by columns images of BitMatrix
+    bitmaps, each width pixels wide, in reading order, with gutter
+    light pixels around and between them. Cells past the last bitmap
+    stay light. Only one row of images is scaled at a time.
+    '''
+    light = '0' * (columns * (width + gutter) + gutter)
+    space = '0' * gutter
+    for r in range(rows):
+        for k in range(gutter):
+            yield light
+        cells = bitmaps[r*columns:(r+1)*columns]
+        if not cells:
+            for k in range(width):
+                yield light
+            continue
+        tail = ('0' * width + space) * (columns - len(cells))
+        last = line = None
+        for parts in zip(*[pixelRows(bitmap, width) for bitmap in cells]):
+            # Join again only when a cell moves to its next module row.
+            if last is None or any(p is not q for p, q in zip(parts, last)):
+                line = space + space.join(parts) + space + tail
+                last = parts
+            yield line
+    for k in range(gutter):
+        yield light
+
+
+# Bytes per pixel, and default dark and light pixels by format.
+pixelFormats = {
+    'L': (b'\x00', b'\xff'),
+    'RGB': (b'\x00\x00\x00', b'\xff\xff\xff'),
+    'BGR': (b'\x00\x00\x00', b'\xff\xff\xff'),
+    'RGBA': (b'\x00\x00\x00\xff', b'\xff\xff\xff\xff'),
+    'BGRA': (b'\x00\x00\x00\xff', b'\xff\xff\xff\xff'),
+    'ARGB': (b'\xff\x00\x00\x00', b'\xff\xff\xff\xff'),
+}
+
+_runs = re.compile('1+|0+')
+_darkRuns = re.compile('1+')
+
+
+def renderInto(bitmap, width, buffer, offset=0, stride=None, format='L',
+               dark=None, light=b''):
+    '''
+    Draw the image of a BitMatrix width pixels wide straight into a
+    writable buffer, such as a bytearray, memoryview or contiguous
+    NumPy array, without any intermediate image.
+    The top left pixel starts at byte offset, rows are stride bytes
+    apart (width pixels by default), and pixels are in format, one
+    of pixelFormats. dark and light are the bytes of one pixel,
+    by default black and white, and light None leaves the light
+    pixels of the buffer untouched, to overlay the code.
+    '''
+    try:
+        black, white = pixelFormats[format]
+    except KeyError:
+        raise ValueError('Error: pixel format must be one of {}.'.format(
+            ', '.join(sorted(pixelFormats))))
+    dark = black if dark is None else bytes(dark)
+    light = white if light == b'' else light
+    if len(dark) != len(black) or light is not None and \
+            len(bytes(light)) != len(black):
+        raise ValueError('Error: {} pixels are {} bytes.'.format(
+            format, len(black)))
+    size = len(black)
+    if stride is None:
+        stride = width * size
+    view = memoryview(buffer)
+    if view.ndim != 1 or view.format != 'B':
+        view = view.cast('B')
+    if offset < 0 or stride < width * size or \
+            offset + (width - 1) * stride + width * size > len(view):
+        raise ValueError('Error: the image does not fit in the buffer.')
+    pixels = {'1': dark, '0': bytes(light) if light is not None else b''}
+    last = line = None
+    for j, bits in enumerate(pixelRows(bitmap, width)):
+        start = offset + j * stride
+        if light is not None:
+            # Whole rows, each distinct row built once, run by run.
+            if bits is not last:
+                line = b''.join([pixels[m.group()[0]] * (m.end() - m.start())
+                                 for m in _runs.finditer(bits)])
+                last = bits
+            view[start:start + len(line)] = line
+        else:
+            for m in _darkRuns.finditer(bits):
+                view[start + m.start() * size:start + m.end() * size] = \
+                    dark * (m.end() - m.start())
+
+
+# Streaming raster writers of BitMatrix images without PIL
+# by upper case format name.
+writers = {
+    'PNG': writePNG,
+    'PBM': writePBM,
+}
+
+# Streaming raster writers of rows of pixels by upper case format name.
+rowWriters = {
+    'PNG': writePNGRows,
+    'PBM': writePBMRows,
+}
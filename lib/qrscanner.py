@@ -13,12 +13,10 @@ Author: Zhihan CHEN<CHEN.Zhihan@outlook.com>
 """
 
 import sys
-import copy
 import reedsolo
-from qrgenerator import _fmtEncode, _fillByte, _encode
-from PIL import Image
+from qrgenerator import _fmtEncode, _blockSizes, _deinterleave, _levels, _levelBits
+from qrsegment import *
 from util import *
-from util import _dataAreaMask
 
 class ImageError(Exception):
     def __init__(self,arg):
@@ -27,6 +25,7 @@ class ImageError(Exception):
         return str(self.arg)
 
 def _readImage(file):
+    from PIL import Image
     try:
         image = Image.open(file)
         return image
@@ -40,128 +39,220 @@ def _sizeCheck(width,height):
     if not width==height:
         raise ImageError("The image must be a square")
 
-def _pixelCheck(pixels,width,matrixWidth=21):
+def _matrixWidth(pixels,width):
+    # The top-left finder pattern starts with a run of 7 dark modules.
+    run=0
+    while run<width and not _boolize(pixels[run,0]):
+        run+=1
+    if run<7:
+        raise ImageError("Not a QR Code")
+    pixelWidth=run//7
+    # The horizontal timing sequence runs until 6 modules before the right edge.
+    k=8
+    while (k+1)*pixelWidth<=width and _boolize(pixels[k*pixelWidth,6*pixelWidth])==bool(k%2):
+        k+=1
+    matrixWidth=k+6
+    if (matrixWidth-17)%4!=0 or not 1<=(matrixWidth-17)//4<=40:
+        raise ImageError("Not a QR Code")
+    return matrixWidth
+
+def _QRFormatCheck(version,bitMap):
+    # Function patterns, without the format code.
+    fixed = ~dataAreaMask(version)
+    for coords in formatPositions(version):
+        for (j,i) in coords:
+            fixed.set(j,i,0)
+    if any(((bitMap^verTemplate(version))&fixed).rows):
+        raise ImageError("QRCode version {} Format not satisfied".format(version))
+
+def _generateBitMap(image,width,matrixWidth=21):
+    # Average the pixels of every module with a box filter, then threshold the means.
+    # The confidence of a module, from 0 to 1, is how far its mean is from the threshold.
+    from PIL import Image
     pixelWidth=width//matrixWidth
-    for jNormal in range(matrixWidth):
-        for iNormal in range(matrixWidth):
-            color=_boolize(pixels[iNormal*pixelWidth,jNormal*pixelWidth])
-            for i in range(pixelWidth):
-                for j  in range(pixelWidth):
-                    if _boolize(pixels[iNormal*pixelWidth+i,jNormal*pixelWidth+j])!=color:
-                        raise ImageError("Not a QR Code")
-    return True
-
-def _fillMaskCodeArea(matrix,maskCodeArray):
-    newMatrix = copy.deepcopy(matrix)
-    newMatrix = copyFrom(transpose(maskCodeArray[7:]), newMatrix, 8, 13)
-    newMatrix = copyFrom(maskCodeArray[9:][::-1], newMatrix, 0, 8)
-    newMatrix = copyFrom(maskCodeArray[7:9][::-1], newMatrix, 7, 8)
-    newMatrix = copyFrom(maskCodeArray[:7][::-1], newMatrix, 14, 8)
-    newMatrix = copyFrom(transpose(maskCodeArray[:6]), newMatrix, 8, 0)
-    newMatrix = copyFrom([maskCodeArray[6]], newMatrix, 8, 7)
-    return newMatrix
-
-_maskCodeArea = _fillMaskCodeArea([[True for i in range(21)] for j in range(21)],[[False] for i in range(15)])
-def _maskCodeAreaAsList():
+    size=pixelWidth*matrixWidth
+    means=image.convert('L').crop((0,0,size,size)).resize((matrixWidth,matrixWidth),Image.BOX).load()
+    bitMap = BitMatrix(matrixWidth)
+    confidence = []
+    for j in range(matrixWidth):
+        row = []
+        for i in range(matrixWidth):
+            if not _boolize(means[i,j]):
+                bitMap.set(j,i)
+            row.append(min(1.0,abs(means[i,j]-122.5)/122.5))
+        confidence.append(row)
+    return bitMap, confidence
+
+def _getMaskCode(bitMap,version=1):
+    # Read both copies of the format code.
+    codes = []
+    for coords in formatPositions(version):
+        code = 0
+        for b,(j,i) in enumerate(coords):
+            code |= bitMap.get(j,i)<<b
+        codes.append(code)
+    for level in _levels:
+        for maskCode in range(8):
+            formatMaskCode = _fmtEncode(int(_levelBits[level]+'{:03b}'.format(maskCode), 2))
+            if formatMaskCode in codes:
+                return level, maskCode
+    raise ImageError("Format information not recognized")
+
+def _getUnmaskedData(bitMap,maskCode,version=1):
+    return (bitMap&dataAreaMask(version))^dataMasks(version)[maskCode]
+
+# Codewords with a module sampled below this confidence are passed to the RS decoder as erasures.
+_erasureConfidence = 0.5
+
+def _getErasures(confidence,version=1):
+    # Codeword indices with their lowest module confidence, least confident first.
+    positions = dataPositions(version)
+    erasures = []
+    for k in range(len(positions)//8):
+        lowest = min(confidence[j][i] for (j,i) in positions[8*k:8*k+8])
+        if lowest<_erasureConfidence:
+            erasures.append((lowest,k))
+    return [k for lowest,k in sorted(erasures)]
+
+def _getEncodedData(bitMap,version=1):
     result = []
-    for i in range(21):
-        for j in range(21):
-            if not _maskCodeArea[j][i]:
-                result.append((j,i))
+    byte = 0
+    for k,(j,i) in enumerate(dataPositions(version)):
+        byte = (byte<<1) | bitMap.get(j,i)
+        if k%8==7:
+            result.append(byte)
+            byte = 0
     return result
 
-def _QRFormatCheck(version,bitMap):
-    if version==1:
-        fourDarks = logicAnd(logicXor(ver1Temp,bitMap), logicNot(_dataAreaMask))
-        result = copy.deepcopy(bitMap)
-        for i in range(len(bitMap)):
-            for j in range(len(bitMap[0])):
-                if not _dataAreaMask[j][i] or not _maskCodeArea[j][i]:
-                    result[j][i]=True
-        if not all([all(i) for i in logicXor(result,ver1Temp)]):
-            raise ImageError("QRCode version 1 Format not satisfied")
-
-def _generateBitMap(pixels,width,matrixWidth=21):
-    result={}
-    bitMap = [[False for x in range(21)] for y in range(21)]
-    pixelWidth=width//matrixWidth
-    for j in range(21):
-        for i in range(21):
-            bitMap[j][i]=_boolize(pixels[i*pixelWidth,j*pixelWidth])
-    return bitMap
-
-def _getMaskCode(bitMap):
-    for maskCode in range(8):
-        formatMaskCode = _fmtEncode(int('01'+'{:03b}'.format(maskCode), 2))
-        maskCodeArray = [[not int(c)] for c in '{:015b}'.format(formatMaskCode)]
-        emptyMatrix = [[True for i in range(21)] for j in range(21)]
-        emptyMatrix = _fillMaskCodeArea(emptyMatrix,maskCodeArray)
-        allFit = True
-        for (j,i) in _maskCodeAreaAsList():
-            if emptyMatrix[j][i]!=bitMap[j][i]:
-                allFit=False
-                break
-        if allFit:
-            return maskCode
-
-def _getUnmaskedData(bitMap,maskCode):
-    return logicXor(logicAnd(bitMap,_dataAreaMask),dataMasks[maskCode])
-
-def _getByte(matrix,downwards=False):
-    if downwards:
-        matrix=matrix[::-1]
-    byteList = [0 for i in range(8)]
-    for i in range(8):
-        byteList[7-i]=1-int(matrix[i//2][i%2])
-    byte = sum([byteList[i]*2**(7-i) for i in range(8)])
-    return byte
-
-def _getEncodedData(bitMap):
-    bytes23_25=[ _getByte(getPart(bitMap,9,4-2*i),i%2==0)for i in range(3)]
-    byte22 = _getByte(getPart(bitMap,9,7))
-    oracle=_fillByte(_encode("hello")[22])
-    bytes19_21 = [ _getByte(getPart(bitMap,9+4*i,9),True) for i in range(3)]
-    byte18_p1 = getPart(bitMap,4,9,2,2)
-    byte18_p2 = getPart(bitMap,7,9,2,2)
-    byte18 = _getByte(byte18_p1+byte18_p2,True)
-    byte17 = _getByte(getPart(bitMap,0,9),True)
-    byte16 = _getByte(getPart(bitMap,0,11))
-    byte15_p1 = getPart(bitMap,4,11,2,2)
-    byte15_p2 = getPart(bitMap,7,11,2,2)
-    byte15 = _getByte(byte15_p1+byte15_p2)
-    bytes0_14 = [ _getByte(getPart(bitMap,21-4*((i%3-1)*(-1)**((i//3)%2)+2),21-2*(i//3+1)),(i//3)%2!=0) for i in range(15)]
-    return bytes0_14+[byte15]+[byte16]+[byte17]+[byte18]+bytes19_21+[byte22]+bytes23_25
-
-def _decodeData(data):
-    decoder = reedsolo.RSCodec(7)
-    data=decoder.decode(data)[:19]
-    heximal = ""
-    for i in data:
-        heximal+="{:02X}".format(i)
-    heximal=heximal[3:]
-    while heximal[-1:]!="0":
-        heximal = heximal[:-2]
-    heximal=heximal[:-1]
-    bytesarr=bytearray.fromhex(heximal)
-    return bytesarr
+def _decodeData(data,version=1,level='L',erasures=()):
+    sizes, ecc = _blockSizes(version,level)
+    blocks = _deinterleave(data[:sum(sizes)],sizes)
+    ecBlocks = _deinterleave(data[sum(sizes):],[ecc]*len(sizes))
+    # Where every codeword of the symbol goes in its block.
+    where = {}
+    for b,indices in enumerate(_deinterleave(range(sum(sizes)),sizes)):
+        for pos,k in enumerate(indices):
+            where[k] = (b,pos)
+    for b,indices in enumerate(_deinterleave(range(sum(sizes),len(data)),[ecc]*len(sizes))):
+        for pos,k in enumerate(indices):
+            where[k] = (b,sizes[b]+pos)
+    # At most ecc erasures per block, the least confident ones.
+    erasePos = [[] for size in sizes]
+    for k in erasures:
+        b,pos = where[k]
+        if len(erasePos[b])<ecc:
+            erasePos[b].append(pos)
+    decoder = reedsolo.get_codec(ecc)
+    data = bytearray()
+    for block, ecBlock, erasePosBlock in zip(blocks, ecBlocks, erasePos):
+        codeword = bytearray(block+ecBlock)
+        try:
+            data.extend(decoder.decode(codeword,erase_pos=erasePosBlock))
+        except reedsolo.ReedSolomonError:
+            # The hints can be wrong, try again with errors only.
+            if not erasePosBlock:
+                raise
+            data.extend(decoder.decode(codeword))
+    return data
 
 def _decodeBytes(bytes):
     return bytes.decode("iso-8859-1")
 
-def scan(filename,matrixWidth=21):
+def _decodeKanji(code):
+    code = (code//0xc0)<<8 | code%0xc0
+    code += 0x8140 if code<0x1f00 else 0xc140
+    return bytearray([code>>8,code&0xff]).decode("shift_jis")
+
+def _decodeSegments(data,version=1):
+    bitstring = ''.join("{:08b}".format(i) for i in data)
+    original = ''
+    structure = None
+    pos = 0
+    while len(bitstring)-pos>=4:
+        mode = int(bitstring[pos:pos+4],2)
+        pos += 4
+        if mode==0:
+            break
+        if mode==STRUCTURED_APPEND:
+            structure = (int(bitstring[pos:pos+4],2),int(bitstring[pos+4:pos+8],2)+1,int(bitstring[pos+8:pos+16],2))
+            pos += 16
+            continue
+        if mode not in (NUMERIC,ALPHANUMERIC,BYTE,KANJI):
+            raise ImageError("Unsupported mode {:04b}".format(mode))
+        countBits = charCountBits(mode,version)
+        count = int(bitstring[pos:pos+countBits],2)
+        pos += countBits
+        if mode==NUMERIC:
+            for k in range(0,count,3):
+                digits = min(3,count-k)
+                original += "{:0{}d}".format(int(bitstring[pos:pos+digits*3+1],2),digits)
+                pos += digits*3+1
+        elif mode==ALPHANUMERIC:
+            for k in range(0,count-1,2):
+                pair = int(bitstring[pos:pos+11],2)
+                original += ALPHANUMERIC_CHARS[pair//45]+ALPHANUMERIC_CHARS[pair%45]
+                pos += 11
+            if count%2:
+                original += ALPHANUMERIC_CHARS[int(bitstring[pos:pos+6],2)]
+                pos += 6
+        elif mode==BYTE:
+            bytesarr = bytearray(int(bitstring[pos+8*k:pos+8*k+8],2) for k in range(count))
+            original += _decodeBytes(bytesarr)
+            pos += 8*count
+        else:
+            for k in range(count):
+                original += _decodeKanji(int(bitstring[pos:pos+13],2))
+                pos += 13
+    return original, structure
+
+def _scanSymbol(filename,matrixWidth=None):
     try:
         image = _readImage(filename)
         pixels=image.load()
         width,height=image.size
         _sizeCheck(width,height)
-        _pixelCheck(pixels,width,matrixWidth)
-        bitMap=_generateBitMap(pixels,width)
-        _QRFormatCheck(1,bitMap)
-        maskCode = _getMaskCode(bitMap)
-        unmaskedData = _getUnmaskedData(bitMap,maskCode)
-        encodedData = _getEncodedData(unmaskedData)
-        decodedData = _decodeData(encodedData)
-        original = _decodeBytes(decodedData)
-        return original
+        if matrixWidth is None:
+            matrixWidth=_matrixWidth(pixels,width)
+        version=(matrixWidth-17)//4
+        bitMap,confidence=_generateBitMap(image,width,matrixWidth)
+        _QRFormatCheck(version,bitMap)
+        level, maskCode = _getMaskCode(bitMap,version)
+        unmaskedData = _getUnmaskedData(bitMap,maskCode,version)
+        encodedData = _getEncodedData(unmaskedData,version)
+        erasures = _getErasures(confidence,version)
+        decodedData = _decodeData(encodedData,version,level,erasures)
+        return _decodeSegments(decodedData,version)
     except Exception as e:
         raise e
+
+def scan(filename,matrixWidth=None):
+    original, structure = _scanSymbol(filename,matrixWidth)
+    return original
+
+def scanSet(filenames):
+    """
+    Reassemble the data of a Structured Append set from the scans of
+    all its symbols, in any order.
+    """
+    filenames = list(filenames)
+    if not filenames:
+        raise ImageError("No symbols to reassemble")
+    parts = {}
+    total = check = None
+    for filename in filenames:
+        original, structure = _scanSymbol(filename)
+        if structure is None:
+            raise ImageError("{} is not part of a Structured Append set".format(filename))
+        position, count, parityCode = structure
+        if total is None:
+            total, check = count, parityCode
+        elif (count,parityCode)!=(total,check):
+            raise ImageError("{} belongs to another set".format(filename))
+        parts[position] = original
+    missing = [str(k+1) for k in range(total) if k not in parts]
+    if missing:
+        raise ImageError("Missing symbols {} of {}".format(', '.join(missing),total))
+    original = ''.join(parts[k] for k in range(total))
+    if parity(original)!=check:
+        raise ImageError("Structured Append parity check failed")
+    return original
@@ -0,0 +1,198 @@
+##########################################
+# File:             qrsegment.py
+##########################################
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''
+    Data segments in numeric, alphanumeric, byte
+    and kanji modes, and the optimal segmentation
+    of input data minimizing the total bit length.
+
+    A segment is a tuple (mode indicator, text).
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''
+
+from util import BitBuffer
+
+# Mode indicators.
+NUMERIC = 0b0001
+ALPHANUMERIC = 0b0010
+BYTE = 0b0100
+KANJI = 0b1000
+
+_modes = (NUMERIC, ALPHANUMERIC, BYTE, KANJI)
+
+# Structured Append header mode indicator, followed by the
+# symbol position, the number of symbols minus 1 and the parity.
+STRUCTURED_APPEND = 0b0011
+
+# Length of the character count indicator for
+# versions 1-9, 10-26 and 27-40.
+_countBits = {
+    NUMERIC: (10, 12, 14),
+    ALPHANUMERIC: (9, 11, 13),
+    BYTE: (8, 16, 16),
+    KANJI: (8, 10, 12),
+}
+
+# Cost of one character in each mode, in sixths of a bit.
+_charCost = {
+    NUMERIC: 20,
+    ALPHANUMERIC: 33,
+    BYTE: 48,
+    KANJI: 78,
+}
+
+ALPHANUMERIC_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:'
+_alnumIndex = dict((c, k) for k, c in enumerate(ALPHANUMERIC_CHARS))
+
+
+def charCountBits(mode, version):
+    '''Length of the character count indicator of mode in version.'''
+    return _countBits[mode][0 if version < 10 else 1 if version < 27 else 2]
+
+
+def kanjiCode(c):
+    '''
+    13-bit kanji mode value of character c,
+    or None if c is not a Shift JIS double-byte character.
+    '''
+    try:
+        b = bytearray(c.encode('shift_jis'))
+    except UnicodeEncodeError:
+        return None
+    if len(b) != 2:
+        return None
+    code = b[0] << 8 | b[1]
+    if 0x8140 <= code <= 0x9ffc:
+        code -= 0x8140
+    elif 0xe040 <= code <= 0xebbf:
+        code -= 0xc140
+    else:
+        return None
+    return (code >> 8) * 0xc0 + (code & 0xff)
+
+
+def parity(data):
+    '''
+    Structured Append parity of data: the XOR of all its bytes,
+    in ISO-8859-1 or Shift JIS for kanji.
+    '''
+    res = 0
+    for c in data:
+        if ord(c) < 256:
+            res ^= ord(c)
+        else:
+            for byte in bytearray(c.encode('shift_jis')):
+                res ^= byte
+    return res
+
+
+def _canEncode(mode, c):
+    if mode == NUMERIC:
+        return '0' <= c <= '9'
+    elif mode == ALPHANUMERIC:
+        return c in _alnumIndex
+    elif mode == BYTE:
+        return ord(c) < 256
+    return kanjiCode(c) is not None
+
+
+def _segmentData(mode, text, buf):
+    '''Append the characters of a segment to buf, without header.'''
+    if mode == NUMERIC:
+        # 3 digits in 10 bits, 2 in 7 bits and 1 in 4 bits.
+        for k in range(0, len(text), 3):
+            group = text[k:k+3]
+            buf.append(int(group), len(group)*3+1)
+    elif mode == ALPHANUMERIC:
+        # 2 characters in 11 bits, 1 in 6 bits.
+        for k in range(0, len(text)-1, 2):
+            buf.append(_alnumIndex[text[k]]*45 + _alnumIndex[text[k+1]], 11)
+        if len(text) % 2:
+            buf.append(_alnumIndex[text[-1]], 6)
+    elif mode == BYTE:
+        # Every character in ISO-8859-1 in 8 bits.
+        for byte in bytearray(text.encode('iso-8859-1')):
+            buf.append(byte, 8)
+    else:
+        for c in text:
+            buf.append(kanjiCode(c), 13)
+
+
+def encodeSegments(segments, version, buf=None):
+    '''
+    Encode segments with mode prefix and character count,
+    appending to buf or to a new BitBuffer. Return the buffer.
+    '''
+    if buf is None:
+        buf = BitBuffer()
+    for mode, text in segments:
+        buf.append(mode, 4)
+        buf.append(len(text), charCountBits(mode, version))
+        _segmentData(mode, text, buf)
+    return buf
+
+
+def segmentsLength(segments, version):
+    '''Number of bits taken by segments, without encoding them.'''
+    bits = 0
+    for mode, text in segments:
+        bits += 4 + charCountBits(mode, version)
+        if mode == NUMERIC:
+            bits += len(text) // 3 * 10 + (0, 4, 7)[len(text) % 3]
+        elif mode == ALPHANUMERIC:
+            bits += len(text) // 2 * 11 + len(text) % 2 * 6
+        elif mode == BYTE:
+            bits += len(text) * 8
+        else:
+            bits += len(text) * 13
+    return bits
+
+
+def optimalSegments(data, version):
+    '''
+    Split data into segments minimizing the total bit length,
+    with a dynamic program over the characters: for each mode,
+    keep the cheapest cost of encoding the prefix so far with
+    its last character in that mode.
+    '''
+    if not data:
+        return []
+    headCost = [(4 + charCountBits(mode, version)) * 6 for mode in _modes]
+    prevCost = headCost
+    # charModes[k][m]: mode of character k on the cheapest path
+    # that continues in mode m after it.
+    charModes = []
+    for c in data:
+        cost = [None] * len(_modes)
+        modes = [None] * len(_modes)
+        for m, mode in enumerate(_modes):
+            if _canEncode(mode, c):
+                cost[m] = prevCost[m] + _charCost[mode]
+                modes[m] = mode
+        encodable = [m for m in range(len(_modes)) if modes[m] is not None]
+        if not encodable:
+            raise ValueError(
+                'Error: character {!r} cannot be encoded.'.format(c))
+        # Switch to a new segment after this character, paying for
+        # the rounding of the current segment to whole bits.
+        ended = [(cost[n] + 5) // 6 * 6 for n in encodable]
+        for m in range(len(_modes)):
+            for n, end in zip(encodable, ended):
+                switch = end + headCost[m]
+                if modes[m] is None or switch < cost[m]:
+                    cost[m] = switch
+                    modes[m] = _modes[n]
+        charModes.append(modes)
+        prevCost = cost
+    # Trace the cheapest path back from the last character.
+    m = min((cost, m) for m, cost in enumerate(prevCost))[1]
+    mode = _modes[m]
+    res = []
+    for k in range(len(data)-1, -1, -1):
+        mode = charModes[k][_modes.index(mode)]
+        if res and res[-1][0] == mode:
+            res[-1][1].append(data[k])
+        else:
+            res.append((mode, [data[k]]))
+    return [(mode, ''.join(text[::-1])) for mode, text in res[::-1]]
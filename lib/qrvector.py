@@ -0,0 +1,158 @@
+##########################################
+# File:             qrvector.py
+##########################################
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''
+    Vector output of module matrices in SVG, PDF
+    and EPS, drawing every horizontal run of dark
+    modules as one rectangle, in module units
+    scaled to the requested width.
+
+'''''''''''''''''''''''''''''''''''''''''''''''''''
+
+import io
+import re
+import zlib
+
+_darkRun = re.compile('1+')
+
+
+def darkRuns(bitmap):
+    '''
+    Horizontal runs of dark modules of a BitMatrix,
+    as tuples (row, first column, length).
+    '''
+    return [(j, m.start(), m.end() - m.start())
+            for j, row in enumerate(bitmap.rowStrings())
+            for m in _darkRun.finditer(row)]
+
+
+def _number(x):
+    '''Shortest decimal form of x for the output.'''
+    return '{:.4f}'.format(x).rstrip('0').rstrip('.')
+
+
+def genSVG(bitmap, width):
+    '''SVG image width pixels wide, as bytes, with a single path.'''
+    path = ''.join('M{} {}h{}v1h-{}z'.format(i, j, length, length)
+                   for j, i, length in darkRuns(bitmap))
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<svg xmlns="http://www.w3.org/2000/svg" width="{0}" '
+            'height="{0}" viewBox="0 0 {1} {2}" '
+            'shape-rendering="crispEdges">'
+            '<rect width="{1}" height="{2}" fill="#fff"/>'
+            '<path d="{3}"/></svg>\n'.format(width, bitmap.width,
+                                             bitmap.height, path)
+            ).encode('ascii')
+
+
+def _rects(bitmap, operator):
+    '''
+    PostScript and PDF rectangles of all dark runs, with the origin
+    at the bottom left, one line per rectangle.
+    '''
+    return ''.join('{} {} {} 1 {}\n'.format(i, bitmap.height - 1 - j,
+                                            length, operator)
+                   for j, i, length in darkRuns(bitmap))
+
+
+def genEPS(bitmap, width):
+    '''EPS image width points wide, as bytes.'''
+    scale = _number(float(width) / bitmap.width)
+    return ('%!PS-Adobe-3.0 EPSF-3.0\n'
+            '%%BoundingBox: 0 0 {0} {0}\n'
+            '%%Pages: 1\n'
+            '%%EndComments\n'
+            'gsave\n'
+            '{1} {1} scale\n'
+            '1 setgray 0 0 {2} {3} rectfill\n'
+            '0 setgray\n'
+            '{4}'
+            'grestore\n'
+            'showpage\n'
+            '%%EOF\n'.format(width, scale, bitmap.width, bitmap.height,
+                             _rects(bitmap, 'rectfill'))).encode('ascii')
+
+
+def _pdfContent(bitmap, size, x=0, y=0):
+    '''
+    PDF drawing of a BitMatrix size points wide with its bottom
+    left corner at (x, y).
+    '''
+    scale = _number(float(size) / bitmap.width)
+    return 'q {0} 0 0 {0} {1} {2} cm\n{3}f Q\n'.format(
+        scale, _number(x), _number(y), _rects(bitmap, 're'))
+
+
+def writePDF(pages, width, height, out):
+    '''
+    Stream a PDF document into the binary file object out, with one
+    page width by height points for each content stream of pages,
+    so that only one page is held in memory at a time.
+    '''
+    # Object numbers: 1 is the catalog, 2 the page tree written last,
+    # then each page and its compressed content stream.
+    offsets = {}
+    written = [0]
+
+    def write(data):
+        out.write(data)
+        written[0] += len(data)
+
+    def writeObject(number, data):
+        offsets[number] = written[0]
+        write('{} 0 obj\n'.format(number).encode('ascii') + data +
+              b'\nendobj\n')
+
+    write(b'%PDF-1.4\n')
+    writeObject(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+    kids = []
+    number = 3
+    for content in pages:
+        stream = zlib.compress(content.encode('ascii'))
+        writeObject(number, '<< /Type /Page /Parent 2 0 R /MediaBox '
+                    '[0 0 {} {}] /Resources << >> /Contents {} 0 R >>'
+                    .format(_number(width), _number(height), number + 1)
+                    .encode('ascii'))
+        writeObject(number + 1, '<< /Length {} /Filter /FlateDecode >>\n'
+                    'stream\n'.format(len(stream)).encode('ascii') +
+                    stream + b'\nendstream')
+        kids.append('{} 0 R'.format(number))
+        number += 2
+    writeObject(2, '<< /Type /Pages /Kids [{}] /Count {} >>'.format(
+        ' '.join(kids), len(kids)).encode('ascii'))
+    xref = written[0]
+    write('xref\n0 {}\n0000000000 65535 f \n'.format(number)
+          .encode('ascii'))
+    for k in range(1, number):
+        write('{:010d} 00000 n \n'.format(offsets[k]).encode('ascii'))
+    write('trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n'
+          .format(number, xref).encode('ascii'))
+
+
+def genPDF(bitmap, width):
+    '''One page PDF document width points wide, as bytes.'''
+    out = io.BytesIO()
+    writePDF([_pdfContent(bitmap, width)], width, width, out)
+    return out.getvalue()
+
+
+def sheetPDF(bitmaps, width, rows, columns, gutter):
+    '''
+    PDF content stream of a page of rows by columns images of BitMatrix
+    bitmaps, each width points wide, in reading order, with gutter
+    points around and between them.
+    '''
+    height = rows * (width + gutter) + gutter
+    return ''.join(_pdfContent(bitmap, width,
+                               gutter + k % columns * (width + gutter),
+                               height - (k // columns + 1) * (width + gutter))
+                   for k, bitmap in enumerate(bitmaps))
+
+
+# Vector writers by upper case format name.
+writers = {
+    'SVG': genSVG,
+    'EPS': genEPS,
+    'PDF': genPDF,
+}
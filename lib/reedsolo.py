@@ -85,6 +85,7 @@ but I'm only testing on 2.5 - 3.2.
 # TODO IMPORTANT: try to keep the same convention for the ordering of polynomials inside lists throughout the code and functions (because for now there are a lot of list reversing in order to make it work, you never know the order of a polynomial, ie, if the first coefficient is the major degree or the constant term...).
 
 import itertools
+import gf256
 
 
 ################### INIT and stuff ###################
@@ -108,8 +109,8 @@ except NameError:
 class ReedSolomonError(Exception):
     pass
 
-gf_exp = bytearray([1] * 512) # For efficiency, gf_exp[] has size 2*GF_SIZE, so that a simple multiplication of two numbers can be resolved without calling % 255. For more infos on how to generate this extended exponentiation table, see paper: "Fast software implementation of finite field operations", Cheng Huang and Lihao Xu, Washington University in St. Louis, Tech. Rep (2003).
-gf_log = bytearray(256)
+gf_exp, gf_log, gf_mul_table, gf_mul_rows = gf256.tables() # shared with the QR code generator. gf_mul_rows[x][y] == x * y, see gf256.tables().
+# For efficiency, gf_exp[] has size 2*GF_SIZE, so that a simple multiplication of two numbers can be resolved without calling % 255. For more infos on how to generate this extended exponentiation table, see paper: "Fast software implementation of finite field operations", Cheng Huang and Lihao Xu, Washington University in St. Louis, Tech. Rep (2003).
 field_charac = int(2**8 - 1)
 
 ################### GALOIS FIELD ELEMENTS MATHS ###################
@@ -189,28 +190,10 @@ def init_tables(prim=0x11d, generator=2, c_exp=8):
     # note that the choice of generator or prime polynomial doesn't matter very much: any two finite fields of size p^n have identical structure, even if they give the individual elements different names (ie, the coefficients of the codeword will be different, but the final result will be the same: you can always correct as many errors/erasures with any choice for those parameters). That's why it makes sense to refer to all the finite fields, and all decoders based on Reed-Solomon, of size p^n as one concept: GF(p^n). It can however impact sensibly the speed (because some parameters will generate sparser tables).
     # c_exp is the exponent for the field's characteristic GF(2^c_exp)
 
-    global gf_exp, gf_log, field_charac
+    global gf_exp, gf_log, gf_mul_table, gf_mul_rows, field_charac
     field_charac = int(2**c_exp - 1)
-    gf_exp = bytearray(field_charac * 2) # anti-log (exponential) table. The first two elements will always be [GF256int(1), generator]
-    gf_log = bytearray(field_charac+1) # log table, log[0] is impossible and thus unused
-
-    # For each possible value in the galois field 2^8, we will pre-compute the logarithm and anti-logarithm (exponential) of this value
-    # To do that, we generate the Galois Field F(2^p) by building a list starting with the element 0 followed by the (p-1) successive powers of the generator α : 1, α, α^1, α^2, ..., α^(p-1).
-    x = 1
-    for i in xrange(field_charac): # we could skip index 255 which is equal to index 0 because of modulo: g^255==g^0 but either way, this does not change the later outputs (ie, the ecc symbols will be the same either way)
-        gf_exp[i] = x # compute anti-log for this value and store it in a table
-        gf_log[x] = i # compute log at the same time
-        x = gf_mult_noLUT(x, generator, prim, field_charac+1)
-
-        # If you use only generator==2 or a power of 2, you can use the following which is faster than gf_mult_noLUT():
-        #x <<= 1 # multiply by 2 (change 1 by another number y to multiply by a power of 2^y)
-        #if x & 0x100: # similar to x >= 256, but a lot faster (because 0x100 == 256)
-            #x ^= prim # substract the primary polynomial to the current value (instead of 255, so that we get a unique set made of coprime numbers), this is the core of the tables generation
-
-    # Optimization: double the size of the anti-log table so that we don't need to mod 255 to stay inside the bounds (because we will mainly use this table for the multiplication of two GF numbers, no more).
-    for i in xrange(field_charac, field_charac * 2):
-        gf_exp[i] = gf_exp[i - field_charac]
-
+    # The tables are built once per field by gf256.tables(), which also builds the full multiplication table so that gf_mul() is a single lookup without branches nor modulo: gf_exp is the anti-log (exponential) table, doubled in size so that gf_exp[gf_log[x] + gf_log[y]] needs no modulo, gf_log the log table (log[0] is impossible and thus unused).
+    gf_exp, gf_log, gf_mul_table, gf_mul_rows = gf256.tables(prim, generator, c_exp)
     return [gf_log, gf_exp]
 
 def gf_add(x, y):
@@ -226,9 +209,7 @@ def gf_inverse(x):
     return gf_exp[field_charac - gf_log[x]] # gf_inverse(x) == gf_div(1, x)
 
 def gf_mul(x, y):
-    if x == 0 or y == 0:
-        return 0
-    return gf_exp[(gf_log[x] + gf_log[y]) % field_charac]
+    return gf_mul_rows[x][y] # precomputed product, 0 if x or y is 0
 
 def gf_div(x, y):
     if y == 0:
@@ -302,7 +283,8 @@ def gf_mult_noLUT(x, y, prim=0, field_charac_full=256, carryless=True):
 ################### GALOIS FIELD POLYNOMIALS MATHS ###################
 
 def gf_poly_scale(p, x):
-    return bytearray([gf_mul(p[i], x) for i in xrange(len(p))])
+    row = gf_mul_rows[x]
+    return bytearray([row[p[i]] for i in xrange(len(p))])
 
 def gf_poly_add(p, q):
     r = bytearray( max(len(p), len(q)) )
@@ -317,16 +299,13 @@ def gf_poly_mul(p, q):
     '''Multiply two polynomials, inside Galois Field (but the procedure is generic). Optimized function by precomputation of log.'''
     # Pre-allocate the result array
     r = bytearray(len(p) + len(q) - 1)
-    # Precompute the logarithm of p
-    lp = [gf_log[p[i]] for i in xrange(len(p))]
     # Compute the polynomial multiplication (just like the outer product of two vectors, we multiply each coefficients of p with all coefficients of q)
     for j in xrange(len(q)):
         qj = q[j] # optimization: load the coefficient once
-        if qj != 0: # log(0) is undefined, we need to check that
-            lq = gf_log[qj] # Optimization: precache the logarithm of the current coefficient of q
+        if qj != 0: # optimization: nothing to add for a zero coefficient
+            row = gf_mul_rows[qj] # Optimization: precache the multiplication table row of the current coefficient of q
             for i in xrange(len(p)):
-                if p[i] != 0: # log(0) is undefined, need to check that...
-                    r[i + j] ^= gf_exp[lp[i] + lq] # equivalent to: r[i + j] = gf_add(r[i+j], gf_mul(p[i], q[j]))
+                r[i + j] ^= row[p[i]] # equivalent to: r[i + j] = gf_add(r[i+j], gf_mul(p[i], q[j]))
     return r
 
 def gf_poly_mul_simple(p, q): # simple equivalent way of multiplying two polynomials without precomputation, but thus it's slower
@@ -352,10 +331,10 @@ def gf_poly_div(dividend, divisor):
     for i in xrange(len(dividend) - (len(divisor)-1)):
         #msg_out[i] /= normalizer # for general polynomial division (when polynomials are non-monic), the usual way of using synthetic division is to divide the divisor g(x) with its leading coefficient (call it a). In this implementation, this means:we need to compute: coef = msg_out[i] / gen[0]. For more infos, see http://en.wikipedia.org/wiki/Synthetic_division
         coef = msg_out[i] # precaching
-        if coef != 0: # log(0) is undefined, so we need to avoid that case explicitly (and it's also a good optimization). In fact if you remove it, it should still work because gf_mul() will take care of the condition. But it's still a good practice to put the condition here.
+        if coef != 0: # optimization: nothing to substract for a zero coefficient
+            row = gf_mul_rows[coef] # precaching
             for j in xrange(1, len(divisor)): # in synthetic division, we always skip the first coefficient of the divisior, because it's only used to normalize the dividend coefficient
-                if divisor[j] != 0: # log(0) is undefined
-                    msg_out[i + j] ^= gf_mul(divisor[j], coef) # equivalent to the more mathematically correct (but xoring directly is faster): msg_out[i + j] += -divisor[j] * coef
+                msg_out[i + j] ^= row[divisor[j]] # equivalent to the more mathematically correct (but xoring directly is faster): msg_out[i + j] += -divisor[j] * coef
 
     # The resulting msg_out contains both the quotient and the remainder, the remainder being the size of the divisor (the remainder has necessarily the same degree as the divisor -- not length but degree == length-1 -- since it's what we couldn't divide from the dividend), so we compute the index where this separation is, and return the quotient and remainder.
     separator = -(len(divisor)-1)
@@ -379,9 +358,10 @@ def gf_poly_square(poly):
 
 def gf_poly_eval(poly, x):
     '''Evaluates a polynomial in GF(2^p) given the value for x. This is based on Horner's scheme for maximum efficiency.'''
+    row = gf_mul_rows[x] # multiplying by x is a single lookup in this row
     y = poly[0]
     for i in xrange(1, len(poly)):
-        y = gf_mul(y, x) ^ poly[i]
+        y = row[y] ^ poly[i]
     return y
 
 
@@ -424,20 +404,18 @@ def rs_encode_msg(msg_in, nsym, fcr=0, generator=2, gen=None):
     msg_in = bytearray(msg_in)
     msg_out = bytearray(msg_in) + bytearray(len(gen)-1) # init msg_out with the values inside msg_in and pad with len(gen)-1 bytes (which is the number of ecc symbols).
 
-    # Precompute the logarithm of every items in the generator
-    lgen = bytearray([gf_log[gen[j]] for j in xrange(len(gen))])
 
     # Extended synthetic division main loop
     # Fastest implementation with PyPy (but the Cython version in creedsolo.pyx is about 2x faster)
     for i in xrange(len(msg_in)):
         coef = msg_out[i] # Note that it's msg_out here, not msg_in. Thus, we reuse the updated value at each iteration (this is how Synthetic Division works: instead of storing in a temporary register the intermediate values, we directly commit them to the output).
         # coef = gf_mul(msg_out[i], gf_inverse(gen[0]))  # for general polynomial division (when polynomials are non-monic), the usual way of using synthetic division is to divide the divisor g(x) with its leading coefficient (call it a). In this implementation, this means:we need to compute: coef = msg_out[i] / gen[0]
-        if coef != 0: # log(0) is undefined, so we need to manually check for this case. There's no need to check the divisor here because we know it can't be 0 since we generated it.
-            lcoef = gf_log[coef] # precaching
+        if coef != 0: # optimization: nothing to substract for a zero coefficient
+            row = gf_mul_rows[coef] # precaching
 
             for j in xrange(1, len(gen)): # in synthetic division, we always skip the first coefficient of the divisior, because it's only used to normalize the dividend coefficient (which is here useless since the divisor, the generator polynomial, is always monic)
                 #if gen[j] != 0: # log(0) is undefined so we need to check that, but it slow things down in fact and it's useless in our case (reed-solomon encoding) since we know that all coefficients in the generator are not 0
-                msg_out[i + j] ^= gf_exp[lcoef + lgen[j]] # optimization, equivalent to gf_mul(gen[j], msg_out[i]) and we just substract it to msg_out[i+j] (but since we are in GF256, it's equivalent to an addition and to an XOR). In other words, this is simply a "multiply-accumulate operation"
+                msg_out[i + j] ^= row[gen[j]] # optimization, equivalent to gf_mul(gen[j], msg_out[i]) and we just substract it to msg_out[i+j] (but since we are in GF256, it's equivalent to an addition and to an XOR). In other words, this is simply a "multiply-accumulate operation"
 
     # Recopy the original message bytes (overwrites the part where the quotient was computed)
     msg_out[:len(msg_in)] = msg_in # equivalent to c = mprime - b, where mprime is msg_in padded with [0]*nsym
@@ -606,9 +584,9 @@ def rs_forney_syndromes(synd, pos, nmess, generator=2):
     # Optimized method, all operations are inlined
     fsynd = list(synd[1:])      # make a copy and trim the first coefficient which is always 0 by definition
     for i in xrange(len(pos)):
-        x = gf_pow(generator, erase_pos_reversed[i])
+        row = gf_mul_rows[gf_pow(generator, erase_pos_reversed[i])]
         for j in xrange(len(fsynd) - 1):
-            fsynd[j] = gf_mul(fsynd[j], x) ^ fsynd[j + 1]
+            fsynd[j] = row[fsynd[j]] ^ fsynd[j + 1]
         #fsynd.pop() # useless? it doesn't change the results of computations to leave it there
 
     # Theoretical way of computing the modified Forney syndromes: fsynd = (erase_loc * synd) % x^(n-k) -- although the trimming by using x^(n-k) is maybe not necessary as many books do not even mention it (and it works without trimming)
@@ -754,11 +732,37 @@ class RSCodec(object):
 
         # Initialize the look-up tables for easy and quick multiplication/division
         init_tables(prim, generator, c_exp)
+        self.gf_mul_rows = gf_mul_rows # the tables of this codec's field, in case another codec switched the global tables since
+        # Products of every symbol with the generator polynomial (skipping its leading 1), each packed as one big integer, for the zero syndrome check in is_codeword()
+        gen = rs_generator_poly(nsym, fcr, generator)
+        self.gen_products = []
+        for x in xrange(field_charac+1):
+            packed = 0
+            for g in gen[1:]:
+                packed = packed << c_exp | gf_mul_rows[x][g]
+            self.gen_products.append(packed)
+
+    def is_codeword(self, chunk):
+        '''Returns true if all the syndromes of the chunk (message + ecc) are zero, ie, if it has no error. This is equivalent to max(rs_calc_syndromes(chunk, nsym)) == 0, but it is computed in one pass as the remainder of the division of the chunk by the generator polynomial (a codeword is a multiple of the generator, whose roots are the ones evaluated by the syndromes), the remainder being a single big integer that is shifted and XORed with one table lookup per symbol.'''
+        c_exp = self.c_exp
+        shift = c_exp * (self.nsym - 1)
+        mask = (1 << shift) - 1
+        table = self.gen_products
+        rem = 0
+        for byte in chunk:
+            rem = (rem & mask) << c_exp ^ table[rem >> shift ^ byte]
+        return rem == 0
+
+    def _use_tables(self):
+        '''Switch the global look-up tables back to this codec's field if another codec changed them (tables are cached, so this is cheap).'''
+        if gf_mul_rows is not self.gf_mul_rows:
+            init_tables(self.prim, self.generator, self.c_exp)
 
     def encode(self, data):
         '''Encode a message (ie, add the ecc symbols) using Reed-Solomon, whatever the length of the message because we use chunking'''
         if isinstance(data, str):
             data = bytearray(data, "latin-1")
+        self._use_tables()
         chunk_size = self.nsize - self.nsym
         enc = bytearray()
         for i in xrange(0, len(data), chunk_size):
@@ -771,6 +775,7 @@ class RSCodec(object):
         # erase_pos is a list of positions where you know (or greatly suspect at least) there is an erasure (ie, wrong character but you know it's at this position). Just input the list of all positions you know there are errors, and this method will automatically split the erasures positions to attach to the corresponding data chunk.
         if isinstance(data, str):
             data = bytearray(data, "latin-1")
+        self._use_tables()
         dec = bytearray()
         for i in xrange(0, len(data), self.nsize):
             # Split the long message in a chunk
@@ -782,7 +787,21 @@ class RSCodec(object):
                 e_pos = [x for x in erase_pos if x <= self.nsize]
                 # Then remove the extract erasures from the big list and also decrement all subsequent positions values by nsize (the current chunk's size) so as to prepare the correct alignment for the next iteration
                 erase_pos = [x - (self.nsize+1) for x in erase_pos if x > self.nsize]
+            # Fast path: if all the syndromes are zero, the chunk is a valid codeword, so skip the errors location and correction entirely (this is the case of nearly all clean inputs)
+            if self.is_codeword(chunk):
+                dec.extend(chunk[:-self.nsym])
+                continue
             # Decode/repair this chunk!
             dec.extend(rs_correct_msg(chunk, self.nsym, fcr=self.fcr, generator=self.generator, erase_pos=e_pos, only_erasures=only_erasures)[0])
         return dec
 
+_codecs = {} # cache of preconfigured codecs, see get_codec()
+
+def get_codec(nsym=10, nsize=255, fcr=0, prim=0x11d, generator=2, c_exp=8):
+    '''Return a shared RSCodec with the given parameters, created only on the first call, so that repeated decodings do not configure a new codec each time.'''
+    key = (nsym, nsize, fcr, prim, generator, c_exp)
+    try:
+        return _codecs[key]
+    except KeyError:
+        codec = _codecs[key] = RSCodec(nsym, nsize, fcr, prim, generator, c_exp)
+        return codec
@@ -5,115 +5,229 @@
 # Last modified:    Jan 17, 2017
 ##########################################
 
-import copy
-from PIL import Image, ImageDraw
+from qrvector import writers as _vectorWriters
+from qrraster import writers as _rasterWriters
+import io
+import os
 
 # Debug echo flag.
 DEBUG = False
 
-# True represents light pixels and False represents dark pixels in PIL.
-LIGHT = True
-DARK = False
+# PIL is only imported by genImage for formats other than those of
+# qrvector and qrraster.
 
 
-def genImage(bitmap, width, filename):
+def genImage(bitmap, width, filename=None, format=None):
     '''
-    Generate image corresponding to the input bitmap
-    with specified width and filename.
+    Generate image corresponding to the input BitMatrix
+    with specified width.
+    filename is a path or a binary file object to write to, in the
+    given image format or the one of the filename extension.
+    Without filename, return the image bytes in the given format,
+    or the PIL Image itself if no format is given either.
+    SVG, PDF and EPS images are drawn as vector graphics, PNG and
+    PBM images are streamed row by row without PIL.
     '''
-    # New image in black-white mode initialized with white.
-    img = Image.new('1', (width, width), 'white')
-    drw = ImageDraw.Draw(img)
+    kind = _imageFormat(filename, format)
+    if kind in _vectorWriters:
+        return _output(_vectorWriters[kind](bitmap, width), filename)
+    if kind in _rasterWriters:
+        return _stream(_rasterWriters[kind], bitmap, width, filename)
+    from PIL import Image
     # Normalized pixel width.
     pwidth = width // len(bitmap)
-    for j in range(width):
-        # Normalized j coordinate in bitmap
-        normalj = j // pwidth
-        for i in range(width):
-            # Normalized i coordinate in bitmap
-            normali = i // pwidth
-            if normalj < len(bitmap) and normali < len(bitmap):
-                # Draw pixel.
-                drw.point((i, j), fill=bitmap[normalj][normali])
-    img.save(filename)
-
-
-def transpose(mat):
-    '''Transpose a matrix'''
-    res = [[mat[j][i] for j in range(len(mat))] for i in range(len(mat[0]))]
-    return res
+    if pwidth == 0:
+        raise ValueError('Error: width must be at least {} pixels.'.format(
+            len(bitmap)))
+    # One pixel per module straight from the packed rows, 1 being
+    # black in the inverted raw mode, scaled up without smoothing.
+    size = pwidth * len(bitmap)
+    modules = Image.frombytes('1', (bitmap.width, bitmap.height),
+                              bitmap.toBytes(), 'raw', '1;I')
+    # New image in black-white mode initialized with white.
+    img = Image.new('1', (width, width), 'white')
+    img.paste(modules.resize((size, size), Image.NEAREST), (0, 0))
+    if filename is not None:
+        img.save(filename, kind)
+    elif format is not None:
+        out = io.BytesIO()
+        img.save(out, kind)
+        return out.getvalue()
+    else:
+        return img
+
+
+# Extensions that are not the PIL name of their format.
+_formatAliases = {'JPG': 'JPEG', 'TIF': 'TIFF'}
+
+
+def _imageFormat(filename, format=None):
+    '''Upper case format, or extension of a filename or file object.'''
+    if format is None:
+        name = getattr(filename, 'name', filename)
+        if not isinstance(name, str):
+            return None
+        format = os.path.splitext(name)[1][1:]
+    format = format.upper()
+    return _formatAliases.get(format, format)
 
 
-def copyFrom(src, dst, top, left):
+def _stream(writer, bitmap, width, filename):
     '''
-    Copy the content of matrix src into matrix dst.
-    The top-left corner of src is positioned at (left, top)
-    in dst.
+    Let a streaming writer write to a path or a file object,
+    or return the bytes it writes.
     '''
-    res = copy.deepcopy(dst)
-    for j in range(len(src)):
-        for i in range(len(src[0])):
-            res[top+j][left+i] = src[j][i]
-    return res
+    if filename is None:
+        out = io.BytesIO()
+        writer(bitmap, width, out)
+        return out.getvalue()
+    if hasattr(filename, 'write'):
+        writer(bitmap, width, filename)
+    else:
+        with open(filename, 'wb') as f:
+            writer(bitmap, width, f)
 
 
-def getPart(matrix,top,left,width=2,height=4):
-    result = [[False for i in range(width)] for j in range(height)]
-    for j in range(height):
-        for i in range(width):
-            result[j][i] = matrix[top+j][left+i]
-    return result
+def _output(data, filename):
+    '''Write bytes data to a path or a file object, or return them.'''
+    if filename is None:
+        return data
+    if hasattr(filename, 'write'):
+        filename.write(data)
+    else:
+        with open(filename, 'wb') as f:
+            f.write(data)
 
 
-def logicAnd(mat1, mat2):
+class BitBuffer(object):
     '''
-    Matrix-wise and.
-    Dark and dark -> dark
-    Light and light -> light
-    Dark and light -> light
-    Light and dark -> light
+    Append-only bit sequence, most significant bit first.
+    Whole bytes go straight into a bytearray, so appending
+    stays linear in the total length.
     '''
-    res = [[True for i in range(len(mat1[0]))] for j in range(len(mat1))]
-    for j in range(len(mat1)):
-        for i in range(len(mat1[0])):
-            res[j][i] = mat1[j][i] or mat2[j][i]
-    return res
+    def __init__(self):
+        self.data = bytearray()
+        # Pending bits not yet forming a whole byte.
+        self._acc = 0
+        self._nacc = 0
 
+    def __len__(self):
+        return 8 * len(self.data) + self._nacc
 
-def logicOr(mat1, mat2):
-    """
-    B + B -> B
-    B + W -> B
-    W + W -> W
-    """
-    res = [[False for i in range(len(mat1[0]))] for j in range(len(mat1))]
-    for j in range(len(mat1)):
-        for i in range(len(mat1[0])):
-            res[j][i] = mat1[j][i] and mat2[j][i]
-    return res
+    def append(self, value, width):
+        '''Append the lowest width bits of value.'''
+        acc = self._acc << width | value & ((1 << width) - 1)
+        nacc = self._nacc + width
+        while nacc >= 8:
+            nacc -= 8
+            self.data.append(acc >> nacc & 0xff)
+        self._acc = acc & ((1 << nacc) - 1)
+        self._nacc = nacc
 
-
-def logicNot(mat1):
-    res = [[False for i in range(len(mat1[0]))] for j in range(len(mat1))]
-    for j in range(len(mat1)):
-        for i in range(len(mat1[0])):
-            res[j][i] = not mat1[j][i]
-    return res
+    def codewords(self):
+        '''Return the bytes, padding the last one with zero bits.'''
+        res = bytearray(self.data)
+        if self._nacc:
+            res.append(self._acc << (8 - self._nacc))
+        return res
 
 
-def logicXor(mat1, mat2):
+class BitMatrix(object):
     '''
-    Matrix-wise xor.
-    Dark xor dark -> light
-    Light xor light -> light
-    Dark xor light -> dark
-    Light xor dark -> dark
+    Matrix of modules packed one row per Python int, the most
+    significant of the width bits being the leftmost module.
+    Set bits are dark modules.
     '''
-    res = [[True for i in range(len(mat1[0]))] for j in range(len(mat1))]
-    for j in range(len(mat1)):
-        for i in range(len(mat1[0])):
-            res[j][i] = mat1[j][i] == mat2[j][i]
-    return res
+    def __init__(self, width, height=None, rows=None):
+        self.width = width
+        self.height = width if height is None else height
+        self.rows = [0] * self.height if rows is None else rows
+
+    def rowStrings(self):
+        '''Rows as strings of '1' for dark and '0' for light modules.'''
+        fmt = '{:0' + str(self.width) + 'b}'
+        return [fmt.format(row) for row in self.rows]
+
+    def toBytes(self):
+        '''
+        Pack into bytes row by row, each row padded with light
+        modules to whole bytes, most significant bit first.
+        '''
+        nbytes = (self.width + 7) // 8
+        pad = nbytes * 8 - self.width
+        res = bytearray()
+        for row in self.rows:
+            row <<= pad
+            res.extend((row >> shift) & 0xff
+                       for shift in range(nbytes*8 - 8, -1, -8))
+        return bytes(res)
+
+    def __len__(self):
+        return self.height
+
+    def __eq__(self, other):
+        return self.width == other.width and self.rows == other.rows
+
+    def __ne__(self, other):
+        return not self == other
+
+    def copy(self):
+        return BitMatrix(self.width, self.height, list(self.rows))
+
+    def get(self, j, i):
+        '''1 if the module at (i, j) is dark, else 0.'''
+        return self.rows[j] >> (self.width-1-i) & 1
+
+    def set(self, j, i, dark=1):
+        bit = 1 << (self.width-1-i)
+        if dark:
+            self.rows[j] |= bit
+        else:
+            self.rows[j] &= ~bit
+
+    def fill(self, top, left, height, width, dark=1):
+        '''Set a height by width rectangle dark, unless specified light.'''
+        bits = ((1 << width) - 1) << (self.width-left-width)
+        for j in range(top, top+height):
+            if dark:
+                self.rows[j] |= bits
+            else:
+                self.rows[j] &= ~bits
+
+    def blit(self, src, top, left):
+        '''
+        Copy the content of matrix src in place.
+        The top-left corner of src is positioned at (left, top).
+        '''
+        shift = self.width-left-src.width
+        keep = ~(((1 << src.width) - 1) << shift)
+        for j, row in enumerate(src.rows):
+            self.rows[top+j] = self.rows[top+j] & keep | row << shift
+
+    def __and__(self, other):
+        '''Dark where both are dark.'''
+        return BitMatrix(self.width, self.height,
+                         [a & b for a, b in zip(self.rows, other.rows)])
+
+    def __xor__(self, other):
+        '''Dark where exactly one is dark, used to apply masks.'''
+        return BitMatrix(self.width, self.height,
+                         [a ^ b for a, b in zip(self.rows, other.rows)])
+
+    def __invert__(self):
+        full = (1 << self.width) - 1
+        return BitMatrix(self.width, self.height,
+                         [row ^ full for row in self.rows])
+
+    def transpose(self):
+        '''Transpose a matrix'''
+        cols = zip(*self.rowStrings())
+        return BitMatrix(self.height, self.width,
+                         [int(''.join(col), 2) for col in cols])
+
+    def count(self):
+        '''Number of dark modules.'''
+        return sum(bin(row).count('1') for row in self.rows)
 
 
 def _timSeq(len, vertical=False):
@@ -122,51 +236,198 @@ def _timSeq(len, vertical=False):
     timing sequence with alternating dark and light
     pixels with length len.
     '''
-    res = [[i % 2 for i in range(len)]]
+    res = BitMatrix(len, 1, [int(('10' * len)[:len], 2)])
     if vertical:
-        res = transpose(res)
+        res = res.transpose()
     return res
 
 # Initialize pre-defined tool matrices.
 
 # Finder pattern.
-_finder = copyFrom(
-                copyFrom(
-                    [[DARK for i in range(3)] for j in range(3)],
-                    [[LIGHT for i in range(5)] for j in range(5)],
-                    1, 1
-                ),
-                [[DARK for i in range(7)] for j in range(7)], 1, 1
-            )
-
-# Alignment pattern. Not used in version 1.
-_align = copyFrom(
-            copyFrom(
-                [[DARK]],
-                [[LIGHT for i in range(3)] for j in range(3)], 1, 1
-            ),
-            [[DARK for i in range(5)] for j in range(5)], 1, 1
-        )
-
-# Version 1 QR code template with finder patterns and timing sequences.
-ver1Temp = [[LIGHT for i in range(21)] for j in range(21)]
-ver1Temp = copyFrom(_finder, ver1Temp, 0, 0)
-ver1Temp = copyFrom(_finder, ver1Temp, 14, 0)
-ver1Temp = copyFrom(_finder, ver1Temp, 0, 14)
-ver1Temp = copyFrom(_timSeq(5), ver1Temp, 6, 8)
-ver1Temp = copyFrom(_timSeq(5, vertical=True), ver1Temp, 8, 6)
-ver1Temp = copyFrom([[DARK]], ver1Temp, 13, 8)
-
-# Data area mask to avoid applying masks to functional area.
-_dataAreaMask = [[DARK for i in range(21)] for j in range(21)]
-_dataAreaMask = copyFrom([[LIGHT for i in range(9)] for j in range(9)],
-                         _dataAreaMask, 0, 0)
-_dataAreaMask = copyFrom([[LIGHT for i in range(9)] for j in range(8)],
-                         _dataAreaMask, 13, 0)
-_dataAreaMask = copyFrom([[LIGHT for i in range(8)] for j in range(9)],
-                         _dataAreaMask, 0, 13)
-_dataAreaMask = copyFrom([[LIGHT for i in range(4)]], _dataAreaMask, 6, 9)
-_dataAreaMask = copyFrom([[LIGHT] for i in range(4)], _dataAreaMask, 9, 6)
+_finder = BitMatrix(7)
+_finder.fill(0, 0, 7, 7)
+_finder.fill(1, 1, 5, 5, dark=0)
+_finder.fill(2, 2, 3, 3)
+
+# Alignment pattern.
+_align = BitMatrix(5)
+_align.fill(0, 0, 5, 5)
+_align.fill(1, 1, 3, 3, dark=0)
+_align.set(2, 2)
+
+# Alignment pattern centre coordinates for versions 1 to 40,
+# index 0 unused.
+_alignPos = [
+    None, [],
+    [6, 18], [6, 22], [6, 26], [6, 30], [6, 34],
+    [6, 22, 38], [6, 24, 42], [6, 26, 46], [6, 28, 50],
+    [6, 30, 54], [6, 32, 58], [6, 34, 62],
+    [6, 26, 46, 66], [6, 26, 48, 70], [6, 26, 50, 74],
+    [6, 30, 54, 78], [6, 30, 56, 82], [6, 30, 58, 86], [6, 34, 62, 90],
+    [6, 28, 50, 72, 94], [6, 26, 50, 74, 98], [6, 30, 54, 78, 102],
+    [6, 28, 54, 80, 106], [6, 32, 58, 84, 110], [6, 30, 58, 86, 114],
+    [6, 34, 62, 90, 118],
+    [6, 26, 50, 74, 98, 122], [6, 30, 54, 78, 102, 126],
+    [6, 26, 52, 78, 104, 130], [6, 30, 56, 82, 108, 134],
+    [6, 34, 60, 86, 112, 138], [6, 30, 58, 86, 114, 142],
+    [6, 34, 62, 90, 118, 146],
+    [6, 30, 54, 78, 102, 126, 150], [6, 24, 50, 76, 102, 128, 154],
+    [6, 28, 54, 80, 106, 132, 158], [6, 32, 58, 84, 110, 136, 162],
+    [6, 26, 54, 82, 110, 138, 166], [6, 30, 58, 86, 114, 142, 170]
+]
+
+
+def matrixSize(version):
+    '''Number of modules on each side of a symbol of the given version.'''
+    return 17 + 4 * version
+
+
+def numDataModules(version):
+    '''
+    Number of modules available for data and EC codewords,
+    remainder bits included.
+    '''
+    res = (16 * version + 128) * version + 64
+    if version >= 2:
+        numAlign = len(_alignPos[version])
+        res -= (25 * numAlign - 10) * numAlign - 55
+        if version >= 7:
+            res -= 36
+    return res
+
+
+def _verEncode(version):
+    '''Encode the 18-bit version code using BCH code.'''
+    g = 0x1f25
+    code = version << 12
+    for i in range(5, -1, -1):
+        if code & (1 << (i+12)):
+            code ^= g << i
+    return (version << 12) | code
+
+
+def _zigzag(area):
+    '''
+    List the data area modules in placement order, two columns
+    at a time from the bottom-right corner, alternating upwards
+    and downwards and skipping the vertical timing sequence.
+    Return the coordinates of every codeword bit, most
+    significant bit first.
+    '''
+    size = len(area)
+    res = []
+    for right in range(size-1, 0, -2):
+        if right <= 6:
+            right -= 1
+        upwards = (right+1) & 2 == 0
+        for vert in range(size):
+            j = size-1-vert if upwards else vert
+            for i in (right, right-1):
+                if area.get(j, i):
+                    res.append((j, i))
+    # Drop the remainder bits.
+    return tuple(res[:len(res) - len(res) % 8])
+
+
+def _formatCoords(size):
+    '''
+    Coordinates of the two copies of the 15 format bits,
+    indexed from the least significant bit.
+    '''
+    first = ([(b, 8) for b in range(6)] + [(7, 8), (8, 8), (8, 7)] +
+             [(8, 14-b) for b in range(9, 15)])
+    second = ([(8, size-1-b) for b in range(8)] +
+              [(size-15+b, 8) for b in range(8, 15)])
+    return tuple(first), tuple(second)
+
+
+def _buildVersion(version):
+    '''
+    Build the function pattern template, the data area mask
+    and the data masks of a version, the zigzag list of
+    codeword bit coordinates and the format bit coordinates.
+    '''
+    size = matrixSize(version)
+    temp = BitMatrix(size)
+    # Dark modules are available for data.
+    area = BitMatrix(size)
+    area.fill(0, 0, size, size)
+    # Finder patterns with separators and format areas.
+    for top, left in ((0, 0), (size-7, 0), (0, size-7)):
+        temp.blit(_finder, top, left)
+    area.fill(0, 0, 9, 9, dark=0)
+    area.fill(size-8, 0, 8, 9, dark=0)
+    area.fill(0, size-8, 9, 8, dark=0)
+    # Timing sequences.
+    temp.blit(_timSeq(size-16), 6, 8)
+    temp.blit(_timSeq(size-16, vertical=True), 8, 6)
+    area.fill(6, 0, 1, size, dark=0)
+    area.fill(0, 6, size, 1, dark=0)
+    # Dark module.
+    temp.set(size-8, 8)
+    # Alignment patterns, except where they overlap finder patterns.
+    pos = _alignPos[version]
+    for j in pos:
+        for i in pos:
+            if (j, i) in ((6, 6), (6, pos[-1]), (pos[-1], 6)):
+                continue
+            temp.blit(_align, j-2, i-2)
+            area.fill(j-2, i-2, 5, 5, dark=0)
+    # Version information, from version 7 onwards.
+    if version >= 7:
+        code = _verEncode(version)
+        for k in range(18):
+            a, b = size-11 + k % 3, k // 3
+            temp.set(a, b, code >> k & 1)
+            temp.set(b, a, code >> k & 1)
+            area.set(a, b, dark=0)
+            area.set(b, a, dark=0)
+    maskList = [
+        BitMatrix(size, rows=[
+            int(''.join(
+                '1' if _maskIsDark(c, i, j)
+                else '0' for i in range(size)
+            ), 2) for j in range(size)
+        ]) for c in range(8)
+    ]
+    masks = [area & mask for mask in maskList]
+    return temp, area, masks, _zigzag(area), _formatCoords(size)
+
+
+# Per-version templates, built lazily by _getVersion.
+_versionCache = {}
+
+
+def _getVersion(version):
+    if version not in _versionCache:
+        _versionCache[version] = _buildVersion(version)
+    return _versionCache[version]
+
+
+def verTemplate(version):
+    '''Template with finder, timing, alignment and version patterns.'''
+    return _getVersion(version)[0]
+
+
+def dataAreaMask(version):
+    '''Data area mask to avoid applying masks to functional area.'''
+    return _getVersion(version)[1]
+
+
+def dataMasks(version):
+    '''Data masks defined in QR standard, restricted to the data area.'''
+    return _getVersion(version)[2]
+
+
+def dataPositions(version):
+    '''Coordinates (j, i) of the codeword bits, in placement order.'''
+    return _getVersion(version)[3]
+
+
+def formatPositions(version):
+    '''Coordinates (j, i) of both copies of the format bits.'''
+    return _getVersion(version)[4]
+
 
 # Data masks defined in QR standard.
 
@@ -190,21 +451,11 @@ def _maskIsDark(index, i, j):
         policy = ((i+j) % 2+(i*j) % 3) % 2
     return policy == 0
 
-_maskList = [
-                [
-                    [
-                        DARK if _maskIsDark(c, i, j)
-                        else LIGHT for i in range(21)
-                    ] for j in range(21)
-                ] for c in range(8)
-            ]
-dataMasks = [logicAnd(_dataAreaMask, mask) for mask in _maskList]
-
 # Generate images for predefined patterns for debug use.
 if DEBUG:
     genImage(_finder, 70, 'finder.jpg')
     genImage(_align, 50, 'alignment.jpg')
-    genImage(ver1Temp, 210, 'version1.jpg')
-    genImage(_dataAreaMask, 210, 'dataAreaMask.jpg')
+    genImage(verTemplate(1), 210, 'version1.jpg')
+    genImage(dataAreaMask(1), 210, 'dataAreaMask.jpg')
     for i in range(8):
-        genImage(dataMasks[i], 210, 'mask'+str(i)+'.jpg')
+        genImage(dataMasks(1)[i], 210, 'mask'+str(i)+'.jpg')
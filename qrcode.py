@@ -5,8 +5,9 @@
 # Last modified:    Jan 17, 2017
 ##########################################
 
-from lib.qrgenerator import generate
-from lib.qrscanner import scan
+from lib.qrgenerator import encode, generate, generateSet, generateSheet
+from lib.qrgenerator import generateArchive, QRCache, QRDiskCache
+from lib.qrscanner import scan, scanSet
 
 if __name__ == '__main__':
     import sys
@@ -25,6 +26,10 @@ if __name__ == '__main__':
         if sys.argv[1] == '-g':
             width = 210
             filename = 'qrcode.jpg'
+            version = None
+            level = 'L'
+            mask = None
+            cache = None
             try:
                 idxw = sys.argv.index('-w')
             except ValueError:
@@ -47,8 +52,57 @@ if __name__ == '__main__':
                     raise InvalidArgs('Invalid arguments')
                 sys.argv.remove('-f')
                 sys.argv.remove(filename)
+            try:
+                idxv = sys.argv.index('-v')
+            except ValueError:
+                pass
+            else:
+                try:
+                    version = int(sys.argv[idxv+1])
+                except Exception:
+                    raise InvalidArgs('Invalid arguments')
+                sys.argv.remove('-v')
+                sys.argv.remove(str(version))
+            try:
+                idxe = sys.argv.index('-e')
+            except ValueError:
+                pass
+            else:
+                try:
+                    level = sys.argv[idxe+1]
+                except Exception:
+                    raise InvalidArgs('Invalid arguments')
+                sys.argv.remove('-e')
+                sys.argv.remove(level)
+            try:
+                idxm = sys.argv.index('-m')
+            except ValueError:
+                pass
+            else:
+                try:
+                    mask = int(sys.argv[idxm+1])
+                except Exception:
+                    raise InvalidArgs('Invalid arguments')
+                sys.argv.remove('-m')
+                sys.argv.remove(str(mask))
+            try:
+                idxc = sys.argv.index('-c')
+            except ValueError:
+                pass
+            else:
+                try:
+                    cache = QRDiskCache(sys.argv[idxc+1])
+                except Exception:
+                    raise InvalidArgs('Invalid arguments')
+                del sys.argv[idxc:idxc+2]
             if len(sys.argv) == 3:
-                generate(sys.argv[2], width, filename)
+                generate(sys.argv[2], width, filename, version, level, mask,
+                         cache=cache)
+            else:
+                raise InvalidArgs('Invalid arguments')
+        elif sys.argv[1] == '-p':
+            if len(sys.argv) == 4:
+                print(QRDiskCache(sys.argv[2]).prune(int(sys.argv[3])))
             else:
                 raise InvalidArgs('Invalid arguments')
         elif sys.argv[1] == '-s':
@@ -60,7 +114,9 @@ if __name__ == '__main__':
             raise InvalidArgs('Invalid arguments')
     except InvalidArgs:
         print('Usage:\n' +
-              'Generate: python qrcode.py -g data [-w width] [-f filename]\n' +
-              'Scan: python qrcode.py -s filename')
+              'Generate: python qrcode.py -g data [-w width] [-f filename] ' +
+              '[-v version] [-e L|M|Q|H] [-m mask] [-c cachedir]\n' +
+              'Scan: python qrcode.py -s filename\n' +
+              'Prune cache: python qrcode.py -p cachedir maxbytes')
     except Exception as e:
         print(e)
@@ -1,13 +1,51 @@
 import qrcode
 
-qrcode.generate('Hello world!')
+# Workers of generateSet import this script again, so the examples
+# only run in the main process.
+if __name__ == '__main__':
+    qrcode.generate('Hello world!')
 
-qrcode.generate('Python QR code!', width=420, filename='example.jpg')
+    qrcode.generate('Python QR code!', width=420, filename='example.jpg')
 
-qrcode.scan('qrcode.jpg')
+    # At least level Q error control, in the smallest version that allows it.
+    qrcode.generate('Python QR code!', filename='levelq.jpg', level='Q')
 
-qrcode.scan('example.jpg')
+    qrcode.scan('qrcode.jpg')
 
-# Exception raised here, as version 1 QR code cannot encode
-# more than 17 characters in byte mode.
-qrcode.generate('012345678901234567')
+    qrcode.scan('example.jpg')
+
+    # Longer data selects a larger version automatically.
+    qrcode.generate('Python QR code with a longer text!', filename='long.jpg')
+
+    # Digits are encoded in numeric mode, so version 1 holds 41 of them.
+    qrcode.generate('01234567890123456789', filename='numeric.jpg', version=1)
+
+    # Encode once, then render the same symbol at several sizes.
+    symbol = qrcode.encode('Python QR code!', level='M')
+    for size in (105, 210, 840):
+        symbol.render(size, 'symbol{}.png'.format(size))
+
+    # Without a filename, get the PNG bytes in memory, or the PIL image.
+    png = qrcode.generate('Python QR code!', filename=None, format='PNG')
+    image = qrcode.generate('Python QR code!', filename=None)
+
+    # SVG, PDF and EPS files are vector graphics, sharp at any size.
+    qrcode.generate('Python QR code!', filename='vector.svg')
+
+    # Label sheets of 8 by 6 codes per page, labels1.png, labels2.png...
+    qrcode.generateSheet(('Label {}'.format(k) for k in range(100)),
+                         filename='labels{}.png')
+
+    # Many codes in one ZIP archive, qrcode1.png, qrcode2.png... inside.
+    qrcode.generateArchive(('Code {}'.format(k) for k in range(1000)),
+                           'codes.zip')
+
+    # Data too long for one symbol is split across up to 16 version 5
+    # QR codes, part1.jpg, part2.jpg..., and joined back when scanned.
+    files = qrcode.generateSet('Python QR code! ' * 100, filename='part{}.jpg',
+                               version=5)
+    qrcode.scanSet(files)
+
+    # Exception raised here, as version 1 QR code cannot encode
+    # more than 17 characters in byte mode.
+    qrcode.generate('python qr code!!!!', version=1)